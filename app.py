@@ -1,9 +1,16 @@
 import os
 import json
 import textwrap
+import re
 import google.generativeai as genai
-from flask import Flask, render_template, url_for, redirect, flash, request, session, jsonify, abort
+from google.api_core import exceptions as google_exceptions
+from flask import Flask, render_template, url_for, redirect, flash, request, session, jsonify, abort, Response, stream_with_context
+from flask import g, has_app_context, has_request_context, before_render_template, template_rendered
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.schema import CreateIndex
 from flask_login import LoginManager, UserMixin, login_user, logout_user, current_user, login_required
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField, TextAreaField, SelectField, RadioField
@@ -13,12 +20,80 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta, time # Se añade 'time'
 import pytz # Se añade para manejar zonas horarias
 import click # Se mantiene 'click' SÓLO para el comando init-db
+import queue
+import threading
+import hashlib
+import base64
+import functools
+import contextvars
+import bisect
+import hmac
+from collections import OrderedDict, Counter
+from itertools import takewhile
+from concurrent.futures import ThreadPoolExecutor
+import random
+from time import monotonic, sleep
 
 # --- Configuración de la App ---
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET_KEY', 'una-clave-secreta-muy-dificil-de-adivinar')
 # Clave secreta para las rutas del Cron Job
 app.config['CRON_SECRET_KEY'] = os.environ.get('CRON_SECRET_KEY', 'default-cron-secret-change-this-in-render')
+# Hilos que atienden usuarios en paralelo dentro de un Cron Job (1 = secuencial)
+app.config['CRON_CONCURRENCIA'] = int(os.environ.get('CRON_CONCURRENCIA', 1))
+app.config['CRON_CONCURRENCIA_MAX'] = int(os.environ.get('CRON_CONCURRENCIA_MAX', 16))
+# Usuarios que comparten un mismo prompt de Gemini en los Cron Jobs (1 = un prompt por usuario)
+app.config['CRON_LOTE_USUARIOS'] = int(os.environ.get('CRON_LOTE_USUARIOS', 1))
+# Usuarios que se cargan por bloque al recorrer la tabla en los Cron Jobs (paginación por id)
+app.config['CRON_TAMANO_BLOQUE'] = int(os.environ.get('CRON_TAMANO_BLOQUE', 500))
+# Usuarios cuyas filas generadas se escriben juntas con un INSERT masivo (y un commit)
+app.config['CRON_LOTE_ESCRITURA'] = int(os.environ.get('CRON_LOTE_ESCRITURA', 200))
+# Caché de respuestas de la IA: entradas en memoria (LRU), vigencia en BD y uso por defecto en los Cron Jobs
+app.config['IA_CACHE_MAX_ENTRADAS'] = int(os.environ.get('IA_CACHE_MAX_ENTRADAS', 512))
+app.config['IA_CACHE_TTL_HORAS'] = float(os.environ.get('IA_CACHE_TTL_HORAS', 12))
+app.config['IA_CACHE_CRON'] = os.environ.get('IA_CACHE_CRON', '1') not in ('0', 'false', 'False')
+# Cliente de Gemini: límite de peticiones, reintentos y circuit breaker
+app.config['GEMINI_PETICIONES_POR_SEGUNDO'] = float(os.environ.get('GEMINI_PETICIONES_POR_SEGUNDO', 5))
+app.config['GEMINI_RAFAGA'] = int(os.environ.get('GEMINI_RAFAGA', 10))
+app.config['GEMINI_MAX_REINTENTOS'] = int(os.environ.get('GEMINI_MAX_REINTENTOS', 4))
+app.config['GEMINI_ESPERA_BASE'] = float(os.environ.get('GEMINI_ESPERA_BASE', 1.0))
+app.config['GEMINI_ESPERA_MAX'] = float(os.environ.get('GEMINI_ESPERA_MAX', 30.0))
+app.config['GEMINI_CIRCUITO_UMBRAL'] = int(os.environ.get('GEMINI_CIRCUITO_UMBRAL', 5))
+app.config['GEMINI_CIRCUITO_SEGUNDOS'] = float(os.environ.get('GEMINI_CIRCUITO_SEGUNDOS', 60))
+# Cola de tareas en BD: si las rutas /cron/* sólo encolan (procesadas por `flask worker`)
+app.config['CRON_USAR_COLA'] = os.environ.get('CRON_USAR_COLA', '0') in ('1', 'true', 'True')
+app.config['CRON_TAREA_MAX_INTENTOS'] = int(os.environ.get('CRON_TAREA_MAX_INTENTOS', 3))
+app.config['CRON_TAREA_VISIBILIDAD_SEGUNDOS'] = int(os.environ.get('CRON_TAREA_VISIBILIDAD_SEGUNDOS', 600)) # Renovada por latido mientras corre
+app.config['CRON_TAREA_RETENCION_HORAS'] = float(os.environ.get('CRON_TAREA_RETENCION_HORAS', 72)) # Luego se borran las terminadas
+# Generación del setup inicial en segundo plano
+app.config['SETUP_IA_HILOS'] = int(os.environ.get('SETUP_IA_HILOS', 4))
+app.config['SETUP_IA_MINUTOS_MAX'] = int(os.environ.get('SETUP_IA_MINUTOS_MAX', 5)) # Tras esto, un 'generando' se considera abandonado
+# Caché compartida del feed: páginas en memoria y cada cuánto se revisa la versión en BD (otros procesos)
+app.config['FEED_CACHE_MAX_ENTRADAS'] = int(os.environ.get('FEED_CACHE_MAX_ENTRADAS', 64))
+app.config['FEED_CACHE_VERSION_SEGUNDOS'] = float(os.environ.get('FEED_CACHE_VERSION_SEGUNDOS', 5))
+# GET condicional (ETag) de las páginas por usuario: el ETag cambia al menos cada ventana (tokens CSRF, plazos)
+app.config['ETAG_VENTANA_SEGUNDOS'] = int(os.environ.get('ETAG_VENTANA_SEGUNDOS', 900))
+# Mensajes del asistente en vivo (SSE). Desactivado por defecto: cada stream ocupa un hilo, y con
+# workers sync bloquearía el worker entero. gunicorn.conf.py pasa a workers gthread si se activa
+app.config['ASISTENTE_SSE'] = os.environ.get('ASISTENTE_SSE', '0') in ('1', 'true', 'True')
+app.config['ASISTENTE_STREAMS_MAX'] = int(os.environ.get('ASISTENTE_STREAMS_MAX', 20)) # Por proceso; el resto usa sondeo
+app.config['ASISTENTE_STREAM_SEGUNDOS'] = int(os.environ.get('ASISTENTE_STREAM_SEGUNDOS', 300)) # Luego el navegador reconecta
+app.config['ASISTENTE_STREAM_SONDEO'] = int(os.environ.get('ASISTENTE_STREAM_SONDEO', 30)) # Revisión de BD (mensajes de otros procesos)
+# Acciones de hábitos que acepta /api/habitos/batch en una sola petición
+app.config['HABITOS_BATCH_MAX'] = int(os.environ.get('HABITOS_BATCH_MAX', 50))
+# La compactación del libro de economía sólo vuelca movimientos con más de esta antigüedad. Debe superar
+# la transacción más larga que inserte movimientos (los ids se asignan al insertar, no al confirmar)
+app.config['ECONOMIA_COMPACTAR_RETRASO_SEGUNDOS'] = int(os.environ.get('ECONOMIA_COMPACTAR_RETRASO_SEGUNDOS', 600))
+# Métricas de rendimiento (/metrics, formato Prometheus). Por defecto se protege con la clave de Cron
+app.config['METRICAS_ACTIVAS'] = os.environ.get('METRICAS_ACTIVAS', '1') not in ('0', 'false', 'False')
+app.config['METRICAS_SECRET_KEY'] = os.environ.get('METRICAS_SECRET_KEY', app.config['CRON_SECRET_KEY'])
+# Depuración de SQL (desarrollo / staging): posibles N+1, consultas lentas y, en modo estricto (tests),
+# una excepción cuando una ruta supera su presupuesto de consultas (ver presupuesto_sql)
+app.config['SQL_DEBUG'] = os.environ.get('SQL_DEBUG', '0') in ('1', 'true', 'True')
+app.config['SQL_DEBUG_LENTA_MS'] = float(os.environ.get('SQL_DEBUG_LENTA_MS', 100))
+app.config['SQL_DEBUG_REPETICIONES'] = int(os.environ.get('SQL_DEBUG_REPETICIONES', 5)) # Misma forma N veces = posible N+1
+app.config['SQL_DEBUG_ESTRICTO'] = os.environ.get('SQL_DEBUG_ESTRICTO', '0') in ('1', 'true', 'True')
+app.config['SQL_PRESUPUESTO_CONSULTAS'] = int(os.environ.get('SQL_PRESUPUESTO_CONSULTAS', 30)) # Si la vista no fija el suyo
 
 
 # --- Configuración de la Base de Datos (Aiven) ---
@@ -30,6 +105,9 @@ elif AIVEN_DB_URI.startswith("postgres://"):
 
 app.config['SQLALCHEMY_DATABASE_URI'] = AIVEN_DB_URI
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+if AIVEN_DB_URI.startswith('sqlite'):
+    # Varios hilos/procesos (cron concurrente, workers) escriben a la vez: esperar el lock en vez de fallar
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 30}}
 
 db = SQLAlchemy(app)
 
@@ -85,6 +163,16 @@ class User(db.Model, UserMixin):
     ai_habitos_a_generar = db.Column(db.Integer, default=3) # Para el setup inicial
     ai_tienda_items_por_dia = db.Column(db.Integer, default=3) # Para el refresh diario
 
+    # Estado de la generación del setup inicial: None, 'generando', 'listo' o 'error'
+    setup_estado = db.Column(db.String(20))
+    setup_iniciado = db.Column(db.DateTime)
+
+    # Versión de los datos del usuario: sube con cada escritura que le afecta (ver con_etag)
+    version_datos = db.Column(db.Integer, nullable=False, default=0)
+
+    # Las stats de arriba son una foto: incluyen los movimientos del libro hasta este id (ver _compactar_economia)
+    ultimo_movimiento_aplicado = db.Column(db.Integer, nullable=False, default=0)
+
     # Relaciones
     areas = db.relationship('AreaVida', backref='autor', lazy=True, cascade="all, delete-orphan")
     misiones = db.relationship('Mision', backref='autor', lazy=True, cascade="all, delete-orphan")
@@ -105,7 +193,11 @@ class AreaVida(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nombre = db.Column(db.String(100), nullable=False)
     icono_svg = db.Column(db.String(100), nullable=False, default='icono-default')
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    # Contadores desnormalizados para el Panel Central. Se actualizan en la misma transacción
+    # que las misiones/hábitos (ver _sumar_contadores_areas); `flask rebuild-counters` los repara.
+    misiones_activas = db.Column(db.Integer, nullable=False, default=0)
+    num_habitos = db.Column(db.Integer, nullable=False, default=0)
     misiones = db.relationship('Mision', backref='area', lazy=True)
     habitos = db.relationship('Habito', backref='area', lazy=True)
 
@@ -122,6 +214,13 @@ class Mision(db.Model):
     
     # ELIMINADO: La relación con 'Pendiente' ya no existe
 
+    __table_args__ = (
+        # /misiones ordena las de un usuario por (completada, plazo); también cubre el FK user_id
+        db.Index('ix_mision_user_completada_plazo', 'user_id', 'completada', 'plazo'),
+        # Cron de verificación: misiones sin completar con el plazo vencido
+        db.Index('ix_mision_completada_plazo', 'completada', 'plazo'),
+    )
+
 # ELIMINADO: El modelo 'Pendiente' ya no es necesario
 
 class Habito(db.Model):
@@ -132,7 +231,7 @@ class Habito(db.Model):
     recompensa_xp = db.Column(db.Integer, default=10)
     recompensa_pesos = db.Column(db.Integer, default=1000) # Recompensa en COP
     penalizacion_vida = db.Column(db.Integer, default=5) # Penalización de HP
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     area_id = db.Column(db.Integer, db.ForeignKey('area_vida.id'), nullable=True) # Ligada a un área
 
 class TiendaItem(db.Model):
@@ -140,15 +239,20 @@ class TiendaItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nombre = db.Column(db.String(200), nullable=False)
     costo_pesos = db.Column(db.Integer, nullable=False) # Costo en COP
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False) # Tienda personalizada
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True) # Tienda personalizada
 
 class LogroCompartido(db.Model):
     __tablename__ = 'logro_compartido'
     id = db.Column(db.Integer, primary_key=True)
     texto = db.Column(db.String(500), nullable=False)
-    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow) # Indexado por ix_logro_compartido_timestamp_id
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
+    __table_args__ = (
+        # Paginación del feed por cursor (timestamp, id): cada página es un range scan
+        db.Index('ix_logro_compartido_timestamp_id', 'timestamp', 'id'),
+    )
+
 # Nuevos Modelos para el Asistente de IA
 class MensajeAsistente(db.Model):
     __tablename__ = 'mensaje_asistente'
@@ -158,12 +262,71 @@ class MensajeAsistente(db.Model):
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     leido = db.Column(db.Boolean, default=False)
 
+    __table_args__ = (
+        # Bandeja del asistente: los no leídos de un usuario en orden, con un solo range scan
+        db.Index('ix_mensaje_asistente_user_leido_ts', 'user_id', 'leido', 'timestamp'),
+    )
+
 class AsistentePersonalidad(db.Model):
     __tablename__ = 'asistente_personalidad'
     id = db.Column(db.Integer, primary_key=True)
     nombre = db.Column(db.String(100), unique=True, nullable=False)
     prompt_descripcion = db.Column(db.Text, nullable=False) # El prompt que se le da a Gemini
 
+class TareaCron(db.Model):
+    __tablename__ = 'tarea_cron'
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(50), nullable=False) # Clave de TAREAS_CRON
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=True)
+    payload = db.Column(db.Text) # JSON con los parámetros de la tarea
+    estado = db.Column(db.String(20), nullable=False, default='pendiente') # pendiente, en_proceso, completada, fallida
+    intentos = db.Column(db.Integer, nullable=False, default=0)
+    max_intentos = db.Column(db.Integer, nullable=False, default=3)
+    visible_desde = db.Column(db.DateTime, nullable=False, default=datetime.utcnow) # No se reclama antes de esta hora
+    ultimo_error = db.Column(db.Text)
+    creado = db.Column(db.DateTime, default=datetime.utcnow)
+    actualizado = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_tarea_cron_estado_visible', 'estado', 'visible_desde'),
+    )
+
+class MovimientoEconomia(db.Model):
+    """
+    Libro de la economía del juego, sólo de inserción: cada recompensa, penalización o compra
+    es una fila con sus deltas de XP, pesos y vida. El saldo vigente de un usuario es su foto
+    (las stats de User) más los movimientos con id > User.ultimo_movimiento_aplicado.
+    """
+    __tablename__ = 'movimiento_economia'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    tipo = db.Column(db.String(20), nullable=False) # 'recompensa', 'penalizacion' o 'compra'
+    origen = db.Column(db.String(50)) # p. ej. 'habito:12', 'mision:7', 'tienda_item:3'
+    xp = db.Column(db.Integer, nullable=False, default=0)
+    pesos = db.Column(db.Integer, nullable=False, default=0)
+    vida = db.Column(db.Integer, nullable=False, default=0)
+    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_movimiento_economia_user_id_id', 'user_id', 'id'),
+    )
+
+class VersionCache(db.Model):
+    """
+    Versión de un conjunto de datos compartido (p. ej. 'feed'). Se incrementa en la misma
+    transacción que lo modifica y forma parte de la clave de caché de todos los procesos.
+    """
+    __tablename__ = 'version_cache'
+    nombre = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class RespuestaIACache(db.Model):
+    __tablename__ = 'respuesta_ia_cache'
+    clave = db.Column(db.String(64), primary_key=True) # sha256 de (modelo, config, prompt normalizado)
+    modelo = db.Column(db.String(100), nullable=False)
+    respuesta = db.Column(db.Text, nullable=False)
+    creado = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+
 # === Formularios (Flask-WTF) ===
 
 class RegistrationStep1Form(FlaskForm):
@@ -240,12 +403,322 @@ class ConfiguracionForm(FlaskForm):
     submit = SubmitField('Guardar Cambios')
 
 
+# === Versión de Datos por Usuario (ETag / 304) ===
+
+# Modelos cuyos cambios alteran las páginas de su usuario (se identifican por user_id)
+MODELOS_DATOS_USUARIO = (Mision, Habito, AreaVida, TiendaItem, LogroCompartido)
+
+# Cambia con cada despliegue: una plantilla nueva invalida los ETags anteriores
+_ETAG_DESPLIEGUE = os.environ.get('RENDER_GIT_COMMIT', '')[:12] or str(int(os.path.getmtime(__file__)))
+
+def _incrementar_version_datos(user_ids, conexion=None):
+    """Sube la versión de datos de `user_ids` (para escrituras masivas que no pasan por el ORM)."""
+    user_ids = sorted({user_id for user_id in user_ids if user_id is not None})
+    if not user_ids:
+        return
+    sentencia = db.update(User.__table__).where(User.__table__.c.id.in_(user_ids)).values(
+        version_datos=db.func.coalesce(User.__table__.c.version_datos, 0) + 1
+    )
+    (conexion or db.session).execute(sentencia)
+
+@event.listens_for(db.session, 'after_flush')
+def _versionar_datos_usuario(session, flush_context):
+    """Toda escritura por el ORM que afecte a un usuario sube su versión, en la misma transacción."""
+    user_ids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, MODELOS_DATOS_USUARIO):
+            user_ids.add(obj.user_id)
+        elif isinstance(obj, User) and obj not in session.new and session.is_modified(obj, include_collections=False):
+            user_ids.add(obj.id)
+    _incrementar_version_datos(user_ids, session.connection())
+
+def _etag_usuario():
+    """
+    ETag débil de la página actual para el usuario actual. No hace consultas: usa current_user,
+    incluido el último movimiento del libro que ya lleva aplicado (ver load_user).
+    """
+    ventana = int(datetime.now(pytz.utc).timestamp() // app.config['ETAG_VENTANA_SEGUNDOS'])
+    partes = (
+        current_user.id, current_user.version_datos or 0, getattr(current_user, 'ultimo_movimiento_visto', 0),
+        request.endpoint, request.query_string,
+        ventana, session.get('csrf_token', ''), _ETAG_DESPLIEGUE
+    )
+    return hashlib.sha256(repr(partes).encode()).hexdigest()[:20]
+
+def con_etag(vista):
+    """
+    GET condicional para páginas por usuario. El ETag se deriva de User.version_datos, así que
+    un If-None-Match que coincide responde 304 antes de ejecutar la vista (y sus consultas).
+    Si hay mensajes flash pendientes la página se renderiza siempre y no se cachea.
+    """
+    @functools.wraps(vista)
+    def envoltura(*args, **kwargs):
+        if request.method != 'GET' or session.get('_flashes'):
+            return vista(*args, **kwargs)
+
+        etag = _etag_usuario()
+        if request.if_none_match.contains_weak(etag):
+            respuesta = Response(status=304)
+        else:
+            respuesta = app.make_response(vista(*args, **kwargs))
+            if respuesta.status_code != 200:
+                return respuesta
+        respuesta.set_etag(etag, weak=True)
+        respuesta.headers['Cache-Control'] = 'private, no-cache'
+        return respuesta
+    return envoltura
+
+# === Métricas de Rendimiento (Prometheus) ===
+
+class RegistroMetricas:
+    """
+    Contadores e histogramas en memoria, con etiquetas, que /metrics exporta en el formato de
+    texto de Prometheus. Son por proceso: con varios workers de gunicorn, cada uno lleva las suyas.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._definiciones = {} # nombre -> (tipo, ayuda, buckets)
+        self._series = {}       # nombre -> {etiquetas: valor (contador) o [conteos por bucket, suma, total]}
+
+    def definir(self, nombre, tipo, ayuda, buckets=None):
+        self._definiciones[nombre] = (tipo, ayuda, tuple(buckets or ()))
+        self._series[nombre] = {}
+
+    def contar(self, nombre, valor=1, **etiquetas):
+        clave = tuple(sorted(etiquetas.items()))
+        with self._lock:
+            series = self._series[nombre]
+            series[clave] = series.get(clave, 0) + valor
+
+    def observar(self, nombre, valor, **etiquetas):
+        clave = tuple(sorted(etiquetas.items()))
+        buckets = self._definiciones[nombre][2]
+        with self._lock:
+            serie = self._series[nombre].get(clave)
+            if serie is None:
+                serie = self._series[nombre][clave] = [[0] * (len(buckets) + 1), 0.0, 0]
+            serie[0][bisect.bisect_left(buckets, valor)] += 1
+            serie[1] += valor
+            serie[2] += 1
+
+    @staticmethod
+    def _etiquetas(pares):
+        if not pares:
+            return ''
+        escapar = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{k}="{escapar(v)}"' for k, v in pares) + '}'
+
+    def texto_prometheus(self):
+        lineas = []
+        with self._lock:
+            for nombre, (tipo, ayuda, buckets) in self._definiciones.items():
+                lineas.append(f'# HELP {nombre} {ayuda}')
+                lineas.append(f'# TYPE {nombre} {tipo}')
+                for clave, serie in sorted(self._series[nombre].items()):
+                    if tipo != 'histogram':
+                        lineas.append(f'{nombre}{self._etiquetas(clave)} {serie}')
+                        continue
+                    conteos, suma, total = serie
+                    acumulado = 0
+                    for limite, conteo in zip(buckets, conteos):
+                        acumulado += conteo
+                        lineas.append(f'{nombre}_bucket{self._etiquetas(clave + (("le", repr(float(limite))),))} {acumulado}')
+                    lineas.append(f'{nombre}_bucket{self._etiquetas(clave + (("le", "+Inf"),))} {total}')
+                    lineas.append(f'{nombre}_sum{self._etiquetas(clave)} {suma}')
+                    lineas.append(f'{nombre}_count{self._etiquetas(clave)} {total}')
+        return '\n'.join(lineas) + '\n'
+
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BUCKETS_CONSULTAS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+BUCKETS_BYTES = (256, 1024, 4096, 16384, 65536, 262144)
+
+metricas = RegistroMetricas()
+metricas.definir('progreso_peticion_segundos', 'histogram', 'Latencia de las peticiones por endpoint (hasta el primer byte en streams).', BUCKETS_SEGUNDOS)
+metricas.definir('progreso_peticiones_total', 'counter', 'Peticiones atendidas por endpoint, método y estado HTTP.')
+metricas.definir('progreso_peticion_consultas_sql', 'histogram', 'Consultas SQL emitidas por petición.', BUCKETS_CONSULTAS)
+metricas.definir('progreso_sql_consultas_total', 'counter', 'Consultas SQL por origen (endpoint, cron:<job> o sin_peticion).')
+metricas.definir('progreso_sql_segundos_total', 'counter', 'Tiempo en la BD por origen.')
+metricas.definir('progreso_plantilla_segundos', 'histogram', 'Tiempo de render por plantilla.', BUCKETS_SEGUNDOS)
+metricas.definir('progreso_plantilla_consultas_sql', 'histogram', 'Consultas SQL emitidas durante el render (cargas perezosas).', BUCKETS_CONSULTAS)
+metricas.definir('progreso_gemini_llamadas_total', 'counter', 'Llamadas a Gemini por resultado (ok, error, cache o cancelada).')
+metricas.definir('progreso_gemini_segundos', 'histogram', 'Latencia de Gemini, reintentos incluidos.', BUCKETS_SEGUNDOS)
+metricas.definir('progreso_gemini_errores_total', 'counter', 'Errores de Gemini por clase.')
+metricas.definir('progreso_gemini_prompt_bytes', 'histogram', 'Tamaño de los prompts enviados a Gemini.', BUCKETS_BYTES)
+metricas.definir('progreso_gemini_respuesta_bytes', 'histogram', 'Tamaño de las respuestas de Gemini.', BUCKETS_BYTES)
+metricas.definir('progreso_cron_ejecuciones_total', 'counter', 'Ejecuciones de cada Cron Job por resultado.')
+metricas.definir('progreso_cron_segundos', 'histogram', 'Duración de cada Cron Job.', BUCKETS_SEGUNDOS)
+metricas.definir('progreso_cron_usuarios_total', 'counter', 'Usuarios procesados por cada Cron Job.')
+metricas.definir('progreso_cron_fallos_total', 'counter', 'Usuarios (o tareas) que fallaron en cada Cron Job.')
+
+# Cron Job en curso: etiqueta las métricas de usuarios, fallos y SQL (se copia a los hilos del Cron)
+_cron_en_curso = contextvars.ContextVar('cron_en_curso', default=None)
+
+def _contar_cron(nombre, cantidad=1):
+    job = _cron_en_curso.get()
+    if job is not None and cantidad and app.config['METRICAS_ACTIVAS']:
+        metricas.contar(nombre, cantidad, job=job)
+
+def _medir_cron(job):
+    """Decorador de las lógicas de Cron: mide duración y resultado, y etiqueta lo que ocurre dentro con `job`."""
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            token = _cron_en_curso.set(job)
+            inicio = monotonic()
+            resultado = 'error'
+            try:
+                valor = funcion(*args, **kwargs)
+                resultado = 'ok'
+                return valor
+            finally:
+                _cron_en_curso.reset(token)
+                if app.config['METRICAS_ACTIVAS']:
+                    metricas.observar('progreso_cron_segundos', monotonic() - inicio, job=job)
+                    metricas.contar('progreso_cron_ejecuciones_total', job=job, resultado=resultado)
+        return envoltura
+    return decorador
+
+def _origen_metricas():
+    if has_request_context():
+        return request.endpoint or 'sin_ruta'
+    job = _cron_en_curso.get()
+    return f'cron:{job}' if job else 'sin_peticion'
+
+@app.before_request
+def _iniciar_metricas_peticion():
+    if app.config['METRICAS_ACTIVAS']:
+        g.metricas_inicio = monotonic()
+        g.metricas_sql = 0
+
+@app.after_request
+def _registrar_metricas_peticion(respuesta):
+    inicio = g.pop('metricas_inicio', None)
+    if inicio is not None:
+        endpoint = request.endpoint or 'sin_ruta'
+        metricas.observar('progreso_peticion_segundos', monotonic() - inicio, endpoint=endpoint, metodo=request.method)
+        metricas.contar('progreso_peticiones_total', endpoint=endpoint, metodo=request.method, estado=respuesta.status_code)
+        metricas.observar('progreso_peticion_consultas_sql', g.get('metricas_sql', 0), endpoint=endpoint)
+    return respuesta
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _inicio_consulta_metricas(conn, cursor, sentencia, parametros, contexto, executemany):
+    if contexto is not None:
+        contexto.metricas_inicio = monotonic()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _fin_consulta_metricas(conn, cursor, sentencia, parametros, contexto, executemany):
+    inicio = getattr(contexto, 'metricas_inicio', None)
+    if inicio is None:
+        return
+    duracion = monotonic() - inicio
+    if app.config['METRICAS_ACTIVAS']:
+        origen = _origen_metricas()
+        metricas.contar('progreso_sql_consultas_total', endpoint=origen)
+        metricas.contar('progreso_sql_segundos_total', duracion, endpoint=origen)
+        if has_app_context() and 'metricas_sql' in g:
+            g.metricas_sql += 1
+    if app.config['SQL_DEBUG']:
+        _depurar_consulta(sentencia, duracion)
+
+@before_render_template.connect_via(app)
+def _inicio_plantilla_metricas(sender, template, context, **extra):
+    if app.config['METRICAS_ACTIVAS'] or app.config['SQL_DEBUG']:
+        g.setdefault('metricas_plantillas', []).append((monotonic(), g.get('metricas_sql', 0), template.name or 'sin_nombre'))
+
+@template_rendered.connect_via(app)
+def _fin_plantilla_metricas(sender, template, context, **extra):
+    pila = g.get('metricas_plantillas')
+    if not pila:
+        return
+    inicio, consultas, nombre = pila.pop()
+    if app.config['METRICAS_ACTIVAS']:
+        metricas.observar('progreso_plantilla_segundos', monotonic() - inicio, plantilla=nombre)
+        if 'metricas_sql' in g:
+            metricas.observar('progreso_plantilla_consultas_sql', g.metricas_sql - consultas, plantilla=nombre)
+
+# --- Depuración de SQL (N+1 y consultas lentas) ---
+# Sólo con SQL_DEBUG=1. Cuenta las sentencias de cada petición, agrupa las que sólo difieren en
+# sus parámetros (la firma de un N+1) y registra las lentas con la ruta y la plantilla en curso.
+
+class PresupuestoSQLExcedido(AssertionError):
+    """Una ruta emitió más consultas que su presupuesto (sólo con SQL_DEBUG_ESTRICTO, pensado para tests)."""
+
+def presupuesto_sql(maximo):
+    """Fija el máximo de consultas SQL de una vista; sin él se usa SQL_PRESUPUESTO_CONSULTAS."""
+    def decorador(vista):
+        vista.presupuesto_sql = maximo
+        return vista
+    return decorador
+
+_RE_LITERALES_SQL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_RE_LISTA_PARAMETROS_SQL = re.compile(r"\((?:\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*,)+\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*\)")
+
+def _forma_sentencia(sentencia):
+    """La sentencia sin sus valores: literales como ? y listas IN (?, ?, ...) colapsadas en (?)."""
+    forma = _RE_LITERALES_SQL.sub('?', sentencia)
+    forma = _RE_LISTA_PARAMETROS_SQL.sub('(?)', forma)
+    return ' '.join(forma.split())
+
+def _plantilla_en_curso():
+    pila = g.get('metricas_plantillas') if has_app_context() else None
+    return pila[-1][2] if pila else None
+
+def _presupuesto_ruta():
+    vista = app.view_functions.get(request.endpoint)
+    return getattr(vista, 'presupuesto_sql', app.config['SQL_PRESUPUESTO_CONSULTAS'])
+
+def _depurar_consulta(sentencia, duracion):
+    plantilla = _plantilla_en_curso()
+    forma = _forma_sentencia(sentencia)
+    if duracion * 1000 >= app.config['SQL_DEBUG_LENTA_MS']:
+        desde = f" (plantilla {plantilla})" if plantilla else ""
+        app.logger.warning(f"Consulta lenta: {duracion * 1000:.0f} ms en {_origen_metricas()}{desde}: {forma[:500]}")
+
+    # Lo que emite un stream después de responder (SSE, chat) no cuenta para la petición
+    if not has_request_context() or g.get('sql_debug_cerrado'):
+        return
+    estado = g.get('sql_debug')
+    if estado is None:
+        estado = g.sql_debug = {'consultas': 0, 'formas': Counter(), 'plantillas': {}}
+    estado['consultas'] += 1
+    estado['formas'][forma] += 1
+    if plantilla:
+        estado['plantillas'].setdefault(forma, set()).add(plantilla)
+
+    # Se lanza en la consulta que sobra: la traza apunta a quien la emitió (vista o plantilla)
+    if app.config['SQL_DEBUG_ESTRICTO'] and estado['consultas'] > _presupuesto_ruta():
+        raise PresupuestoSQLExcedido(
+            f"{request.endpoint} superó su presupuesto de {_presupuesto_ruta()} consultas SQL. Última: {forma[:300]}"
+        )
+
+@app.after_request
+def _informe_sql_debug(respuesta):
+    """Con SQL_DEBUG: cabecera X-SQL-Consultas y aviso de las formas repetidas (posibles N+1)."""
+    if not app.config['SQL_DEBUG'] or not has_request_context():
+        return respuesta
+    estado = g.pop('sql_debug', None) or {'consultas': 0, 'formas': Counter(), 'plantillas': {}}
+    g.sql_debug_cerrado = True
+    respuesta.headers['X-SQL-Consultas'] = str(estado['consultas'])
+    for forma, veces in estado['formas'].most_common():
+        if veces < app.config['SQL_DEBUG_REPETICIONES']:
+            break
+        desde = ', '.join(sorted(estado['plantillas'].get(forma, ()))) or 'la vista'
+        app.logger.warning(f"Posible N+1 en {request.endpoint}: {veces} consultas con la misma forma (desde {desde}): {forma[:300]}")
+    app.logger.debug(f"{request.method} {request.path} ({request.endpoint}): {estado['consultas']} consulta(s) SQL")
+    return respuesta
+
 # === Rutas de Autenticación y Registro con IA ===
 
+# Rutas que sólo necesitan el id del usuario: no se pliega su saldo (las pestañas abiertas las sondean)
+ENDPOINTS_SIN_SALDO = {'get_mensajes_asistente', 'asistente_stream'}
+
 @login_manager.user_loader
 def load_user(user_id):
     try:
-        return User.query.get(int(user_id))
+        user = User.query.get(int(user_id))
+        if user is not None and not (has_request_context() and request.endpoint in ENDPOINTS_SIN_SALDO):
+            _aplicar_cola_economia(user) # Saldo vigente: foto + cola del libro
+        return user
     except Exception as e:
         app.logger.error(f"Error en load_user: {e}")
         return None
@@ -343,72 +816,43 @@ def register_step_3():
 @login_required
 def generar_setup_ia():
     """
-    Ruta de carga que llama a la IA para el setup inicial
+    Lanza en segundo plano la generación del setup inicial y muestra una página de espera
+    que consulta /api/setup_status. Un doble envío nunca genera dos veces.
     """
-    try:
-        if not current_user.metas_profesionales:
-             flash('Debes completar el registro primero.', 'danger')
-             return redirect(url_for('register_step_3'))
-        
-        if current_user.areas: # Evitar que corra dos veces
-            flash('Tu ProgreSO ya ha sido generado.', 'info')
-            return redirect(url_for('index'))
+    if not current_user.metas_profesionales:
+         flash('Debes completar el registro primero.', 'danger')
+         return redirect(url_for('register_step_3'))
+    
+    if current_user.areas: # Evitar que corra dos veces
+        flash('Tu ProgreSO ya ha sido generado.', 'info')
+        return redirect(url_for('index'))
 
+    if _reclamar_setup_ia(current_user.id):
         app.logger.info(f"Iniciando generación de IA para usuario: {current_user.email}")
-        ai_response = _generar_setup_ia_logic(current_user) # Llamada a la función helper
-        
-        if not ai_response:
-             flash('Hubo un error con la IA. Se usarán valores por defecto.', 'danger')
-             return redirect(url_for('index'))
+        _lanzar_setup_ia(current_user.id)
 
-        # Procesar la respuesta JSON de la IA
-        data = json.loads(ai_response)
-        
-        # 1. Crear Áreas de Vida
-        areas_map = {}
-        for area in data.get('areas_vida', []):
-            nueva_area = AreaVida(
-                nombre=area.get('nombre'),
-                icono_svg=area.get('icono_svg', 'icono-default'),
-                autor=current_user
-            )
-            db.session.add(nueva_area)
-            db.session.flush() 
-            areas_map[area.get('nombre')] = nueva_area.id
-
-        # 2. Crear Hábitos
-        for habito in data.get('habitos', []):
-            area_id = areas_map.get(habito.get('area_nombre'))
-            nuevo_habito = Habito(
-                titulo=habito.get('titulo'),
-                recompensa_xp=habito.get('recompensa_xp', 10),
-                recompensa_pesos=habito.get('recompensa_pesos', 1000),
-                penalizacion_vida=habito.get('penalizacion_vida', 5),
-                autor=current_user,
-                area_id=area_id
-            )
-            db.session.add(nuevo_habito)
-
-        # 3. Crear Items de Tienda Personalizados (Lote Inicial)
-        for item in data.get('recompensas_tienda', []):
-            nuevo_item = TiendaItem(
-                nombre=item.get('nombre'),
-                costo_pesos=item.get('costo_pesos', 10000),
-                autor=current_user
-            )
-            db.session.add(nuevo_item)
-            
-        db.session.commit()
-        app.logger.info(f"Generación de IA completada para: {current_user.email}")
-        flash('¡Tu plan de vida personalizado ha sido generado por la IA!', 'success')
-        
-    except Exception as e:
-        db.session.rollback()
-        app.logger.error(f"Error fatal en 'generar_setup_ia' para {current_user.email}: {e}")
-        flash('Hubo un error procesando la respuesta de la IA. Por favor, contacta a soporte.', 'danger')
-        
-    return redirect(url_for('index'))
+    return render_template('generando_setup.html', title='Generando tu ProgreSO')
 
+@app.route('/api/setup_status')
+@login_required
+def setup_status():
+    """
+    Estado de la generación del setup inicial (para la página de espera). Un 'listo' sin áreas
+    se informa como 'error' (se puede reintentar) y un 'generando' vencido como 'abandonado'
+    (la página vuelve a /generar_setup_ia, que lo reclama).
+    """
+    estado = current_user.setup_estado
+    tiene_areas = bool(current_user.areas)
+    if estado is None and tiene_areas:
+        estado = 'listo'
+    elif estado == 'listo' and not tiene_areas:
+        estado = 'error'
+    elif estado == 'generando' and (
+        current_user.setup_iniciado is None
+        or current_user.setup_iniciado < datetime.utcnow() - timedelta(minutes=app.config['SETUP_IA_MINUTOS_MAX'])
+    ):
+        estado = 'abandonado'
+    return jsonify({'estado': estado or 'pendiente'})
 
 @app.route('/logout')
 @login_required
@@ -419,6 +863,7 @@ def logout():
 # === Rutas de la Aplicación ===
 
 @app.route('/')
+@presupuesto_sql(6)
 @login_required
 def index():
     """Ruta principal: El Panel Central (Dashboard)."""
@@ -426,28 +871,49 @@ def index():
         return redirect(url_for('register_step_2'))
     if not current_user.metas_personales:
         return redirect(url_for('register_step_3'))
-    if not current_user.areas: 
+
+    areas = _datos_dashboard(current_user.id)
+    if not areas: 
         return redirect(url_for('generar_setup_ia'))
 
     stats = current_user
-    xp_percent = 0
-    if stats.xp_siguiente_nivel > 0:
-        xp_percent = (stats.xp_actual / stats.xp_siguiente_nivel) * 100
-    
-    areas = AreaVida.query.filter_by(user_id=stats.id).all()
     
     return render_template(
         'index.html',
         title='Panel Central',
         stats=stats,
-        xp_percent=xp_percent,
+        xp_percent=_xp_percent(stats),
         areas=areas,
         datetime=datetime,
         timedelta=timedelta
     )
 
+@app.route('/api/dashboard')
+@presupuesto_sql(6)
+@login_required
+def api_dashboard():
+    """Los mismos datos del Panel Central en JSON."""
+    stats = current_user
+    areas = _datos_dashboard(stats.id)
+    for area in areas:
+        for mision in area['top_misiones']:
+            mision['plazo'] = mision['plazo'].isoformat() if mision['plazo'] else None
+    return jsonify({
+        'stats': {
+            'nivel': stats.nivel,
+            'vida': stats.vida,
+            'pesos': stats.pesos,
+            'xp_actual': stats.xp_actual,
+            'xp_siguiente_nivel': stats.xp_siguiente_nivel,
+            'xp_percent': _xp_percent(stats)
+        },
+        'areas': areas
+    })
+
 @app.route('/areas', methods=['GET', 'POST'])
+@presupuesto_sql(6)
 @login_required
+@con_etag
 def areas():
     """Página para gestionar las Áreas de Vida."""
     form = AreaVidaForm()
@@ -471,10 +937,17 @@ def areas():
     )
 
 @app.route('/misiones', methods=['GET'])
+@presupuesto_sql(4)
 @login_required
+@con_etag
 def misiones():
     """Página para ver Misiones Diarias (solo lectura)."""
-    lista_misiones = Mision.query.filter_by(user_id=current_user.id).order_by(Mision.completada.asc(), Mision.plazo.asc()).all()
+    lista_misiones = (
+        Mision.query.filter_by(user_id=current_user.id)
+        .options(db.joinedload(Mision.area)) # La plantilla muestra el área de cada misión
+        .order_by(Mision.completada.asc(), Mision.plazo.asc())
+        .all()
+    )
     
     return render_template(
         'misiones.html',
@@ -485,7 +958,9 @@ def misiones():
     )
 
 @app.route('/habitos', methods=['GET', 'POST'])
+@presupuesto_sql(8)
 @login_required
+@con_etag
 def habitos():
     """Página para gestionar los Hábitos."""
     form = HabitoForm()
@@ -501,11 +976,12 @@ def habitos():
             autor=current_user
         )
         db.session.add(nuevo_habito)
+        _sumar_contadores_areas('num_habitos', {form.area_id.data: 1})
         db.session.commit()
         flash('¡Hábito creado!', 'success')
         return redirect(url_for('habitos'))
 
-    lista_habitos = Habito.query.filter_by(user_id=current_user.id).all()
+    lista_habitos = Habito.query.filter_by(user_id=current_user.id).options(db.joinedload(Habito.area)).all()
     return render_template(
         'habitos.html',
         title='Hábitos',
@@ -514,7 +990,9 @@ def habitos():
     )
 
 @app.route('/tienda', methods=['GET', 'POST'])
+@presupuesto_sql(10)
 @login_required
+@con_etag
 def tienda():
     """Página de La Tienda (Recompensas Personalizadas)."""
     if request.method == 'POST':
@@ -525,11 +1003,14 @@ def tienda():
              flash('Acción no permitida.', 'danger')
              return redirect(url_for('tienda'))
 
-        if current_user.pesos >= item.costo_pesos:
-            current_user.pesos -= item.costo_pesos
+        # El saldo se comprueba con la fila del usuario bloqueada: dos compras simultáneas no gastan el mismo saldo
+        db.session.execute(db.select(User.id).where(User.id == current_user.id).with_for_update())
+        stats = _aplicar_recompensa(current_user.id, pesos=-item.costo_pesos, tipo='compra', origen=f'tienda_item:{item.id}')
+        if stats['pesos'] >= 0:
             db.session.commit()
             flash(f'¡Has comprado "{item.nombre}"!', 'success')
         else:
+            db.session.rollback()
             flash('No tienes suficientes pesos (COP).', 'danger')
         return redirect(url_for('tienda'))
 
@@ -543,7 +1024,9 @@ def tienda():
     )
 
 @app.route('/perfil')
+@presupuesto_sql(3)
 @login_required
+@con_etag
 def perfil():
     """Página de Perfil y Estadísticas detalladas."""
     return render_template(
@@ -553,6 +1036,7 @@ def perfil():
     )
 
 @app.route('/feed', methods=['GET', 'POST'])
+@presupuesto_sql(8)
 @login_required
 def feed():
     """Página social para compartir y ver logros."""
@@ -564,17 +1048,134 @@ def feed():
         )
         db.session.add(logro)
         db.session.commit()
+        # Quien publica debe ver su logro aunque otro proceso tenga aún la versión anterior
+        session['feed_version'] = _version_feed['version']
         flash('¡Logro compartido!', 'success')
         return redirect(url_for('feed'))
         
-    logros_publicos = LogroCompartido.query.order_by(LogroCompartido.timestamp.desc()).limit(20).all()
+    logros_publicos, logros_html, siguiente = _pagina_feed_cacheada()
     
     return render_template(
         'feed.html',
         title='Feed de Logros',
         form=form,
-        logros=logros_publicos
+        logros=logros_publicos,
+        logros_html=logros_html,
+        siguiente=siguiente
+    )
+
+@app.route('/api/feed')
+@presupuesto_sql(4)
+@login_required
+def api_feed():
+    """Página siguiente del feed (scroll infinito): `before` es el cursor devuelto en la anterior."""
+    antes = None
+    if request.args.get('before'):
+        try:
+            antes = _leer_cursor_feed(request.args['before'])
+        except ValueError:
+            return jsonify({'error': 'Cursor inválido.'}), 400
+
+    logros, logros_html, siguiente = _pagina_feed_cacheada(antes)
+    return jsonify({
+        'logros': [
+            {'id': l['id'], 'texto': l['texto'], 'username': l['username'], 'timestamp': l['timestamp'].isoformat()}
+            for l in logros
+        ],
+        'html': logros_html,
+        'siguiente': siguiente
+    })
+
+# --- Feed: paginación por cursor ---
+
+FEED_POR_PAGINA = 20
+
+def _cursor_feed(timestamp, logro_id):
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{logro_id}".encode()).decode()
+
+def _leer_cursor_feed(cursor):
+    """Devuelve (timestamp, id) del cursor. Lanza ValueError si no es válido."""
+    try:
+        timestamp, logro_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(timestamp), int(logro_id)
+    except ValueError as e: # binascii.Error y UnicodeDecodeError son ValueError
+        raise ValueError(f"Cursor de feed inválido: {cursor!r}") from e
+
+def _pagina_feed(antes=None, limite=FEED_POR_PAGINA):
+    """
+    Una página del feed, del más nuevo al más antiguo, con el username del autor en la misma consulta.
+    `antes` es (timestamp, id) del último logro visto: la condición por tupla usa el índice
+    (timestamp, id), así que la página N cuesta lo mismo que la primera.
+    Devuelve (logros, cursor_siguiente o None).
+    """
+    consulta = (
+        db.select(LogroCompartido.id, LogroCompartido.texto, LogroCompartido.timestamp, User.username)
+        .join(User, User.id == LogroCompartido.user_id)
+        .order_by(LogroCompartido.timestamp.desc(), LogroCompartido.id.desc())
+        .limit(limite + 1)
     )
+    if antes is not None:
+        consulta = consulta.where(db.tuple_(LogroCompartido.timestamp, LogroCompartido.id) < antes)
+    filas = db.session.execute(consulta).all()
+
+    logros = [dict(fila._mapping) for fila in filas[:limite]]
+    siguiente = None
+    if len(filas) > limite:
+        siguiente = _cursor_feed(logros[-1]['timestamp'], logros[-1]['id'])
+    return logros, siguiente
+
+# --- Feed: caché compartida con invalidación por versión ---
+# Todos los usuarios ven el mismo feed: cada página se consulta y renderiza una vez por versión.
+# La versión vive en BD (tabla version_cache) y se incrementa al insertar un LogroCompartido,
+# así que los demás procesos la ven como mucho FEED_CACHE_VERSION_SEGUNDOS después.
+
+_version_feed = {'version': None, 'leida': 0.0}
+
+def _version_cache_feed(minima=None):
+    """Versión actual del feed; sólo se lee de la BD si la copia local caducó o es anterior a `minima`."""
+    ahora = monotonic()
+    version = _version_feed['version']
+    if (version is None or ahora - _version_feed['leida'] > app.config['FEED_CACHE_VERSION_SEGUNDOS']
+            or (minima is not None and version < minima)):
+        version = db.session.scalar(db.select(VersionCache.version).where(VersionCache.nombre == 'feed')) or 0
+        _version_feed.update(version=version, leida=ahora)
+    return version
+
+def _pagina_feed_cacheada(antes=None):
+    """(logros, html de las tarjetas, cursor siguiente) de una página del feed, compartida entre usuarios."""
+    clave = (_version_cache_feed(session.get('feed_version')), antes)
+    pagina = _cache_feed.get(clave)
+    if pagina is None:
+        logros, siguiente = _pagina_feed(antes)
+        pagina = (logros, render_template('feed_logros.html', logros=logros), siguiente)
+        _cache_feed.set(clave, pagina)
+    return pagina
+
+def _incrementar_version_cache(conexion, nombre):
+    """Incrementa la versión `nombre` en la transacción de `conexion` y devuelve la nueva."""
+    tabla = VersionCache.__table__
+    actualizadas = conexion.execute(
+        db.update(tabla).where(tabla.c.nombre == nombre).values(version=tabla.c.version + 1)
+    ).rowcount
+    if not actualizadas:
+        conexion.execute(db.insert(tabla).values(nombre=nombre, version=1))
+    return conexion.execute(db.select(tabla.c.version).where(tabla.c.nombre == nombre)).scalar()
+
+@event.listens_for(db.session, 'after_flush')
+def _registrar_logros_nuevos(session, flush_context):
+    if any(isinstance(obj, LogroCompartido) for obj in session.new):
+        session.info['feed_version'] = _incrementar_version_cache(session.connection(), 'feed')
+
+@event.listens_for(db.session, 'after_commit')
+def _publicar_version_feed(session):
+    version = session.info.pop('feed_version', None)
+    if version is not None:
+        # Este proceso ve el cambio al instante; los demás al revisar la versión
+        _version_feed.update(version=version, leida=monotonic())
+
+@event.listens_for(db.session, 'after_rollback')
+def _descartar_version_feed(session):
+    session.info.pop('feed_version', None)
 
 @app.route('/configuracion', methods=['GET', 'POST'])
 @login_required
@@ -606,73 +1207,273 @@ def configuracion():
     )
 
 
+# --- Datos del Panel Central ---
+
+def _xp_percent(stats):
+    if stats.xp_siguiente_nivel > 0:
+        return (stats.xp_actual / stats.xp_siguiente_nivel) * 100
+    return 0
+
+def _sumar_contadores_areas(columna, incrementos):
+    """
+    Suma `incrementos` {area_id: n} al contador `columna` de cada área con un UPDATE
+    atómico (executemany), dentro de la transacción de quien llama.
+    """
+    filas = [{'area': area_id, 'delta': n} for area_id, n in incrementos.items() if area_id is not None and n]
+    if not filas:
+        return
+    tabla = AreaVida.__table__
+    db.session.execute(
+        db.update(tabla)
+        .where(tabla.c.id == db.bindparam('area'))
+        .values({columna: tabla.c[columna] + db.bindparam('delta')}),
+        filas
+    )
+
+def _recalcular_contadores_areas():
+    """Recalcula desde cero los contadores de TODAS las áreas (un solo UPDATE). Devuelve las filas tocadas."""
+    activas = (
+        db.select(db.func.count(Mision.id))
+        .where(Mision.area_id == AreaVida.id, Mision.completada == False)
+        .scalar_subquery()
+    )
+    habitos = db.select(db.func.count(Habito.id)).where(Habito.area_id == AreaVida.id).scalar_subquery()
+    resultado = db.session.execute(
+        db.update(AreaVida).values(misiones_activas=activas, num_habitos=habitos),
+        execution_options={'synchronize_session': False}
+    )
+    db.session.commit()
+    return resultado.rowcount
+
+def _top_por_area(modelo, columnas, condiciones, orden, limite=3):
+    """
+    Los `limite` primeros elementos de cada área en UNA consulta con una función de ventana.
+    Devuelve {area_id: [filas]}.
+    """
+    numeradas = (
+        db.select(
+            modelo.area_id,
+            *columnas,
+            db.func.row_number().over(partition_by=modelo.area_id, order_by=orden).label('posicion')
+        )
+        .where(*condiciones)
+        .subquery()
+    )
+    filas = db.session.execute(
+        db.select(numeradas).where(numeradas.c.posicion <= limite).order_by(numeradas.c.area_id, numeradas.c.posicion)
+    ).all()
+
+    por_area = {}
+    for fila in filas:
+        por_area.setdefault(fila.area_id, []).append(fila)
+    return por_area
+
+def _datos_dashboard(user_id):
+    """
+    Datos del Panel Central: por área, el número de misiones activas y de hábitos (contadores
+    de AreaVida), y los 3 primeros de cada uno. Son 3 consultas fijas que no dependen del
+    número de áreas ni del historial de misiones completadas.
+    """
+    areas = db.session.execute(
+        db.select(AreaVida.id, AreaVida.nombre, AreaVida.icono_svg, AreaVida.misiones_activas, AreaVida.num_habitos)
+        .where(AreaVida.user_id == user_id)
+        .order_by(AreaVida.id)
+    ).all()
+    if not areas:
+        return []
+
+    misiones = _top_por_area(
+        Mision, (Mision.titulo, Mision.plazo),
+        (Mision.user_id == user_id, Mision.completada == False),
+        (Mision.plazo, Mision.id)
+    )
+    habitos = _top_por_area(
+        Habito, (Habito.titulo, Habito.racha),
+        (Habito.user_id == user_id,),
+        Habito.id
+    )
+
+    datos = []
+    for area in areas:
+        datos.append({
+            'id': area.id,
+            'nombre': area.nombre,
+            'icono_svg': area.icono_svg,
+            'misiones_activas': area.misiones_activas or 0,
+            'habitos': area.num_habitos or 0,
+            'top_misiones': [{'titulo': m.titulo, 'plazo': m.plazo} for m in misiones.get(area.id, [])],
+            'top_habitos': [{'titulo': h.titulo, 'racha': h.racha} for h in habitos.get(area.id, [])]
+        })
+    return datos
+
 # === Rutas de Acciones (Completar, Fallar, etc.) ===
 
+def _quiere_json():
+    """Las acciones responden JSON si se llaman con fetch (cuerpo JSON o Accept: application/json)."""
+    return request.is_json or request.accept_mimetypes.best_match(['text/html', 'application/json']) == 'application/json'
+
+def _stats_json(stats):
+    """
+    Contrato común de las respuestas JSON que cambian la economía: 'stats' (saldo final, listo
+    para pintar) y 'delta' (lo que cambió). base.html lo aplica al DOM con actualizarStats().
+    """
+    return {
+        'stats': {
+            'nivel': stats['nivel'],
+            'xp_actual': stats['xp_actual'],
+            'xp_siguiente_nivel': stats['xp_siguiente_nivel'],
+            'xp_percent': (stats['xp_actual'] / stats['xp_siguiente_nivel']) * 100 if stats['xp_siguiente_nivel'] > 0 else 0,
+            'pesos': stats['pesos'],
+            'pesos_formateados': format_pesos_filter(stats['pesos']),
+            'vida': stats['vida']
+        },
+        'delta': stats['delta']
+    }
+
 @app.route('/completar_habito/<int:habito_id>', methods=['POST'])
+@presupuesto_sql(10)
 @login_required
 def completar_habito(habito_id):
     habito = Habito.query.get_or_404(habito_id)
-    if habito.autor != current_user:
+    if habito.user_id != current_user.id:
+        if _quiere_json():
+            return jsonify({'success': False, 'error': 'No autorizado'}), 403
         return redirect(request.referrer or url_for('habitos'))
 
-    current_user.xp_actual += habito.recompensa_xp
-    current_user.pesos += habito.recompensa_pesos
-    habito.racha += 1
-    current_user.vida = min(current_user.vida + 1, 100)
-    
-    if current_user.xp_siguiente_nivel > 0 and current_user.xp_actual >= current_user.xp_siguiente_nivel:
-        current_user.nivel += 1
-        current_user.xp_actual -= current_user.xp_siguiente_nivel
-        current_user.xp_siguiente_nivel = int(current_user.xp_siguiente_nivel * 1.5)
-        flash(f'¡Felicidades, subiste al Nivel {current_user.nivel}!', 'success')
-
+    _sumar_racha_habito(habito.id)
+    stats = _aplicar_recompensa(
+        current_user.id, xp=habito.recompensa_xp, pesos=habito.recompensa_pesos, vida=1, origen=f'habito:{habito.id}'
+    )
     db.session.commit()
-    flash(f'¡Hábito "{habito.titulo}" completado! (+{habito.recompensa_xp} XP, +${habito.recompensa_pesos} COP)', 'info')
+
+    mensaje = f'¡Hábito "{habito.titulo}" completado! (+{habito.recompensa_xp} XP, +${habito.recompensa_pesos} COP)'
+    if _quiere_json():
+        return jsonify({
+            'success': True,
+            'mensaje': mensaje,
+            'habito_id': habito.id,
+            'racha': habito.racha, # Recargada tras el commit: ya incluye este completado
+            'subio_de_nivel': stats['niveles_subidos'] > 0,
+            'nuevo_nivel': stats['nivel'],
+            **_stats_json(stats)
+        })
+
+    if stats['niveles_subidos']:
+        flash(f'¡Felicidades, subiste al Nivel {stats["nivel"]}!', 'success')
+    flash(mensaje, 'info')
     return redirect(request.referrer or url_for('habitos'))
 
 @app.route('/fallar_habito/<int:habito_id>', methods=['POST'])
+@presupuesto_sql(10)
 @login_required
 def fallar_habito(habito_id):
     habito = Habito.query.get_or_404(habito_id)
-    if habito.autor != current_user:
+    if habito.user_id != current_user.id:
+        if _quiere_json():
+            return jsonify({'success': False, 'error': 'No autorizado'}), 403
         return redirect(request.referrer or url_for('habitos'))
         
-    current_user.vida = max(current_user.vida - habito.penalizacion_vida, 0)
-    
     racha_rota = habito.racha
-    habito.racha = 0
+    _romper_racha_habito(habito.id)
+    stats = _aplicar_recompensa(current_user.id, vida=-habito.penalizacion_vida, tipo='penalizacion', origen=f'habito:{habito.id}')
     
     db.session.commit()
     
     if racha_rota > 0:
-        flash(f'Racha de "{habito.titulo}" rota. ¡Ánimo! (-{habito.penalizacion_vida} HP)', 'warning')
+        mensaje = f'Racha de "{habito.titulo}" rota. ¡Ánimo! (-{habito.penalizacion_vida} HP)'
     else:
-        flash(f'Hábito fallado. (-{habito.penalizacion_vida} HP)', 'warning')
-        
+        mensaje = f'Hábito fallado. (-{habito.penalizacion_vida} HP)'
+    if _quiere_json():
+        return jsonify({'success': True, 'mensaje': mensaje, 'habito_id': habito.id, 'racha': 0, **_stats_json(stats)})
+
+    flash(mensaje, 'warning')
     return redirect(request.referrer or url_for('habitos'))
 
 
+ACCIONES_HABITO = ('completar', 'fallar')
+
+@app.route('/api/habitos/batch', methods=['POST'])
+@presupuesto_sql(10)
+@login_required
+def api_habitos_batch():
+    """
+    Aplica varias acciones sobre hábitos en UNA transacción.
+    Cuerpo: {"items": [{"habito_id": 1, "action": "completar" | "fallar"}, ...]} (en orden).
+    Las rachas se actualizan en bloque y recompensas y penalizaciones se suman con un solo
+    cálculo de saldo y subidas de nivel. Si algún item no es válido no se aplica ninguno.
+    """
+    data = request.get_json(silent=True)
+    items = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({'success': False, 'error': 'Envía una lista "items" con las acciones.'}), 400
+    if len(items) > app.config['HABITOS_BATCH_MAX']:
+        return jsonify({'success': False, 'error': f'Máximo {app.config["HABITOS_BATCH_MAX"]} acciones por petición.'}), 400
+
+    acciones = []
+    for item in items:
+        habito_id = item.get('habito_id') if isinstance(item, dict) else None
+        accion = item.get('action') if isinstance(item, dict) else None
+        if not isinstance(habito_id, int) or isinstance(habito_id, bool) or accion not in ACCIONES_HABITO:
+            return jsonify({'success': False, 'error': 'Cada item necesita "habito_id" (entero) y "action" (completar o fallar).'}), 400
+        acciones.append((habito_id, accion))
+
+    habitos = {
+        h.id: h for h in Habito.query.filter(
+            Habito.id.in_({habito_id for habito_id, _ in acciones}), Habito.user_id == current_user.id
+        )
+    }
+    desconocidos = sorted({habito_id for habito_id, _ in acciones} - set(habitos))
+    if desconocidos:
+        return jsonify({'success': False, 'error': 'Hábitos no encontrados.', 'habitos': desconocidos}), 404
+
+    rachas_previas = {h.id: h.racha or 0 for h in habitos.values()}
+    cambios = _aplicar_rachas(acciones)
+    movimientos = []
+    for habito_id, accion in acciones:
+        habito = habitos[habito_id]
+        if accion == 'completar':
+            movimientos.append({'tipo': 'recompensa', 'origen': f'habito:{habito_id}',
+                                'xp': habito.recompensa_xp or 0, 'pesos': habito.recompensa_pesos or 0, 'vida': 1})
+        else:
+            movimientos.append({'tipo': 'penalizacion', 'origen': f'habito:{habito_id}',
+                                'xp': 0, 'pesos': 0, 'vida': -(habito.penalizacion_vida or 0)})
+    stats = _aplicar_movimientos(current_user.id, movimientos)
+    db.session.commit()
+
+    return jsonify({
+        'success': True,
+        'habitos': [
+            {'habito_id': habito_id, 'racha': completados if reinicia else rachas_previas[habito_id] + completados}
+            for habito_id, (reinicia, completados) in cambios.items()
+        ],
+        'subio_de_nivel': stats['niveles_subidos'] > 0,
+        'nuevo_nivel': stats['nivel'],
+        **_stats_json(stats)
+    })
+
 @app.route('/completar_mision/<int:mision_id>', methods=['POST'])
+@presupuesto_sql(10)
 @login_required
 def completar_mision(mision_id):
     """Marca una misión principal como completada y da recompensas."""
     mision = Mision.query.get_or_404(mision_id)
-    if mision.autor != current_user:
+    if mision.user_id != current_user.id:
         return jsonify({'success': False, 'error': 'No autorizado'}), 403
     
-    if mision.completada:
+    # Marcado condicional: con dos clics simultáneos sólo uno cobra la recompensa
+    marcada = db.session.execute(
+        db.update(Mision.__table__)
+        .where(Mision.__table__.c.id == mision.id, Mision.__table__.c.completada == False)
+        .values(completada=True)
+    ).rowcount
+    if not marcada:
+        db.session.rollback()
         return jsonify({'success': False, 'error': 'Misión ya completada'}), 400
 
-    current_user.xp_actual += mision.recompensa_xp
-    current_user.pesos += mision.recompensa_pesos
-    mision.completada = True
-    
-    subio_de_nivel = False
-    if current_user.xp_siguiente_nivel > 0 and current_user.xp_actual >= current_user.xp_siguiente_nivel:
-        current_user.nivel += 1
-        current_user.xp_actual -= current_user.xp_siguiente_nivel
-        current_user.xp_siguiente_nivel = int(current_user.xp_siguiente_nivel * 1.5)
-        subio_de_nivel = True
+    _sumar_contadores_areas('misiones_activas', {mision.area_id: -1})
+    stats = _aplicar_recompensa(
+        current_user.id, xp=mision.recompensa_xp, pesos=mision.recompensa_pesos, origen=f'mision:{mision.id}'
+    )
 
     db.session.commit()
     
@@ -681,62 +1482,829 @@ def completar_mision(mision_id):
         'mensaje': f'¡Misión "{mision.titulo}" completada!',
         'recompensa_xp': mision.recompensa_xp,
         'recompensa_pesos': mision.recompensa_pesos,
-        'subio_de_nivel': subio_de_nivel,
-        'nuevo_nivel': current_user.nivel,
+        'subio_de_nivel': stats['niveles_subidos'] > 0,
+        'nuevo_nivel': stats['nivel'],
         'stats_actualizados': { 
-            'xp': current_user.xp_actual,
-            'xp_siguiente': current_user.xp_siguiente_nivel,
-            'pesos_formateados': format_pesos_filter(current_user.pesos)
-        }
+            'xp': stats['xp_actual'],
+            'xp_siguiente': stats['xp_siguiente_nivel'],
+            'pesos_formateados': format_pesos_filter(stats['pesos'])
+        },
+        **_stats_json(stats)
     })
 
+# --- Economía: libro de movimientos ---
+# XP, pesos y vida no se reescriben en la fila del usuario: cada recompensa, penalización o
+# compra es un INSERT en MovimientoEconomia. La fila del usuario es una foto que
+# `_compactar_economia` pone al día periódicamente; el saldo vigente es foto + cola del libro.
+
+COLUMNAS_ECONOMIA = ('nivel', 'xp_actual', 'xp_siguiente_nivel', 'pesos', 'vida')
+
+def _subir_niveles(nivel, xp_actual, xp_siguiente_nivel):
+    """
+    Aplica de una vez todas las subidas de nivel que permite `xp_actual` (el umbral crece x1.5
+    por nivel, así que son O(log xp) pasos). Devuelve (nivel, xp_actual, xp_siguiente_nivel, niveles_subidos).
+    """
+    subidos = 0
+    while xp_siguiente_nivel > 0 and xp_actual >= xp_siguiente_nivel:
+        xp_actual -= xp_siguiente_nivel
+        xp_siguiente_nivel = int(xp_siguiente_nivel * 1.5)
+        nivel += 1
+        subidos += 1
+    return nivel, xp_actual, xp_siguiente_nivel, subidos
+
+def _plegar_economia(foto, movimientos):
+    """
+    Aplica `movimientos` (en orden de id) sobre `foto`: suma XP y pesos, acota la vida a 0..100
+    tras cada uno y al final aplica las subidas de nivel. Devuelve un dict con COLUMNAS_ECONOMIA.
+    """
+    xp_actual, pesos, vida = foto['xp_actual'] or 0, foto['pesos'] or 0, foto['vida'] or 0
+    for movimiento in movimientos:
+        xp_actual += movimiento['xp']
+        pesos += movimiento['pesos']
+        vida = min(100, max(0, vida + movimiento['vida']))
+    nivel, xp_actual, xp_siguiente_nivel, _ = _subir_niveles(foto['nivel'] or 1, xp_actual, foto['xp_siguiente_nivel'] or 0)
+    return {'nivel': nivel, 'xp_actual': xp_actual, 'xp_siguiente_nivel': xp_siguiente_nivel, 'pesos': pesos, 'vida': vida}
+
+def _colas_economia(marcas):
+    """
+    Movimientos posteriores a la marca de cada usuario ({user_id: marca}) en UNA consulta sobre
+    ix_movimiento_economia_user_id_id. Devuelve {user_id: [movimientos en orden de id]}.
+    """
+    m = MovimientoEconomia
+    filas = db.session.execute(
+        db.select(m.id, m.user_id, m.xp, m.pesos, m.vida, m.timestamp)
+        .join(User, User.id == m.user_id)
+        .where(m.user_id.in_(list(marcas)), m.id > User.ultimo_movimiento_aplicado)
+        .order_by(m.user_id, m.id)
+    ).all()
+    colas = {}
+    for fila in filas:
+        if fila.id > marcas[fila.user_id]: # La foto leída puede ser anterior a una compactación
+            colas.setdefault(fila.user_id, []).append(fila._mapping)
+    return colas
+
+def _aplicar_cola_economia(user, cola=None):
+    """
+    Pone en `user` el saldo vigente (su foto + la cola del libro) sin marcarlo como modificado,
+    así que nunca se escribe de vuelta. Deja en `user.ultimo_movimiento_visto` el último
+    movimiento incluido, que forma parte del ETag de sus páginas. `cola` evita la consulta
+    si ya se leyó (ver _aplicar_colas_economia).
+    """
+    marca = user.ultimo_movimiento_aplicado or 0
+    if cola is None:
+        cola = _colas_economia({user.id: marca}).get(user.id, [])
+    estado = _plegar_economia({columna: getattr(user, columna) for columna in COLUMNAS_ECONOMIA}, cola)
+    for columna, valor in estado.items():
+        set_committed_value(user, columna, valor)
+    user.ultimo_movimiento_visto = cola[-1]['id'] if cola else marca
+
+def _aplicar_colas_economia(users):
+    """_aplicar_cola_economia para un bloque de usuarios, con UNA consulta de colas."""
+    colas = _colas_economia({user.id: user.ultimo_movimiento_aplicado or 0 for user in users})
+    for user in users:
+        _aplicar_cola_economia(user, colas.get(user.id, []))
+
+@event.listens_for(User, 'refresh')
+def _replegar_economia(user, contexto, atributos):
+    """Tras un commit current_user se recarga desde la foto: se le vuelve a aplicar la cola."""
+    if 'ultimo_movimiento_visto' in user.__dict__ and (atributos is None or set(atributos) & set(COLUMNAS_ECONOMIA)):
+        with db.session.no_autoflush:
+            _aplicar_cola_economia(user)
+
+def _estado_economia(user_id):
+    """Saldo vigente de `user_id` leído de la BD (foto + cola), sin cargar el objeto User."""
+    foto = db.session.execute(
+        db.select(*(getattr(User, columna) for columna in COLUMNAS_ECONOMIA), User.ultimo_movimiento_aplicado)
+        .where(User.id == user_id)
+    ).first()
+    cola = _colas_economia({user_id: foto.ultimo_movimiento_aplicado or 0}).get(user_id, [])
+    return _plegar_economia(foto._mapping, cola)
+
+def _aplicar_movimientos(user_id, movimientos):
+    """
+    Registra `movimientos` (dicts con tipo, origen, xp, pesos y vida) en el libro con UN INSERT
+    executemany: la fila del usuario no se toca, así que clics simultáneos o una penalización del
+    cron no compiten por ella. El saldo resultante se calcula una vez para todos, con una sola
+    pasada de subidas de nivel. No hace commit.
+    Devuelve nivel, xp_actual, xp_siguiente_nivel, pesos, vida, niveles_subidos y el `delta` aplicado.
+    """
+    antes = _estado_economia(user_id)
+    ahora = datetime.utcnow()
+    nuevos = [dict(movimiento, user_id=user_id, timestamp=ahora) for movimiento in movimientos]
+    db.session.execute(db.insert(MovimientoEconomia.__table__), nuevos)
+    despues = _plegar_economia(antes, nuevos)
+    delta = {
+        'xp': sum(movimiento['xp'] for movimiento in nuevos),
+        'pesos': despues['pesos'] - antes['pesos'],
+        'vida': despues['vida'] - antes['vida'], # Ya acotada a 0..100
+        'niveles': despues['nivel'] - antes['nivel']
+    }
+    return dict(despues, niveles_subidos=delta['niveles'], delta=delta)
+
+def _aplicar_recompensa(user_id, xp=0, pesos=0, vida=0, tipo='recompensa', origen=None):
+    """Registra UN movimiento en el libro (ver _aplicar_movimientos). No hace commit."""
+    return _aplicar_movimientos(user_id, [{'tipo': tipo, 'origen': origen, 'xp': xp, 'pesos': pesos, 'vida': vida}])
+
+def _compactar_economia(shard=None, num_shards=None):
+    """
+    Vuelca la cola del libro sobre la foto de cada usuario y avanza su marca, por bloques de
+    usuarios (un SELECT de fotos, uno de colas y un UPDATE executemany por bloque). El UPDATE es
+    condicional a la marca leída: dos compactaciones simultáneas no aplican dos veces un
+    movimiento, y los que se inserten entretanto quedan en la cola. Devuelve los usuarios compactados.
+
+    Los ids del libro se asignan al insertar pero pueden confirmarse en otro orden (p. ej. en
+    PostgreSQL), y la marca deja fuera todo id menor. Por eso sólo se vuelca el prefijo de la cola
+    anterior a ECONOMIA_COMPACTAR_RETRASO_SEGUNDOS: la marca nunca pasa de un movimiento más
+    reciente, y un id menor aún sin confirmar implicaría una transacción abierta más que ese margen.
+    """
+    tabla = User.__table__
+    c = tabla.c
+    corte = datetime.utcnow() - timedelta(seconds=app.config['ECONOMIA_COMPACTAR_RETRASO_SEGUNDOS'])
+    con_cola = db.exists().where(
+        MovimientoEconomia.user_id == c.id, MovimientoEconomia.id > c.ultimo_movimiento_aplicado,
+        MovimientoEconomia.timestamp < corte
+    )
+    actualizar = (
+        db.update(tabla)
+        .where(c.id == db.bindparam('b_id'), c.ultimo_movimiento_aplicado == db.bindparam('b_marca'))
+        .values(
+            ultimo_movimiento_aplicado=db.bindparam('b_nueva_marca'),
+            **{columna: db.bindparam(f'b_{columna}') for columna in COLUMNAS_ECONOMIA}
+        )
+    )
+
+    compactados = 0
+    ultimo_id = 0
+    while True:
+        fotos = db.session.execute(
+            db.select(c.id, c.ultimo_movimiento_aplicado, *(c[columna] for columna in COLUMNAS_ECONOMIA))
+            .where(c.id > ultimo_id, con_cola, *_filtro_shard(c.id, shard, num_shards))
+            .order_by(c.id)
+            .limit(app.config['CRON_TAMANO_BLOQUE'])
+        ).all()
+        if not fotos:
+            break
+        ultimo_id = fotos[-1].id
+
+        colas = _colas_economia({foto.id: foto.ultimo_movimiento_aplicado for foto in fotos})
+        filas = []
+        for foto in fotos:
+            cola = list(takewhile(lambda movimiento: movimiento['timestamp'] < corte, colas.get(foto.id, [])))
+            if not cola:
+                continue
+            estado = _plegar_economia(foto._mapping, cola)
+            filas.append({
+                'b_id': foto.id, 'b_marca': foto.ultimo_movimiento_aplicado, 'b_nueva_marca': cola[-1]['id'],
+                **{f'b_{columna}': valor for columna, valor in estado.items()}
+            })
+        if filas:
+            db.session.execute(actualizar, filas)
+        db.session.commit()
+        compactados += len(filas)
+
+    app.logger.info(f"Economía compactada: {compactados} usuario(s).")
+    return compactados
+
+def _sumar_racha_habito(habito_id):
+    tabla = Habito.__table__
+    db.session.execute(db.update(tabla).where(tabla.c.id == habito_id).values(racha=tabla.c.racha + 1))
+
+def _romper_racha_habito(habito_id):
+    tabla = Habito.__table__
+    db.session.execute(db.update(tabla).where(tabla.c.id == habito_id).values(racha=0))
+
+def _aplicar_rachas(acciones):
+    """
+    Aplica en bloque las acciones [(habito_id, 'completar' | 'fallar')], en orden: un fallo deja
+    la racha en los completados posteriores a él; sin fallos, los completados se suman. Son dos
+    UPDATE executemany como mucho. Devuelve {habito_id: (reinicia, completados)}.
+    """
+    cambios = {}
+    for habito_id, accion in acciones:
+        reinicia, completados = cambios.get(habito_id, (False, 0))
+        cambios[habito_id] = (True, 0) if accion == 'fallar' else (reinicia, completados + 1)
+
+    tabla = Habito.__table__
+    c = tabla.c
+    sumar = [{'b_id': h, 'b_n': n} for h, (reinicia, n) in cambios.items() if not reinicia and n]
+    fijar = [{'b_id': h, 'b_n': n} for h, (reinicia, n) in cambios.items() if reinicia]
+    if sumar:
+        db.session.execute(
+            db.update(tabla).where(c.id == db.bindparam('b_id')).values(racha=c.racha + db.bindparam('b_n')), sumar
+        )
+    if fijar:
+        db.session.execute(db.update(tabla).where(c.id == db.bindparam('b_id')).values(racha=db.bindparam('b_n')), fijar)
+    return cambios
+
+# --- Mensajes del Asistente (SSE y sondeo) ---
+
+class AvisosMensajes:
+    """
+    Despierta a los streams SSE de un usuario cuando se confirma un MensajeAsistente nuevo
+    en ESTE proceso. Los mensajes escritos por otros procesos (p. ej. `flask worker`) se
+    detectan con la revisión periódica del stream (ASISTENTE_STREAM_SONDEO).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._condiciones = {} # user_id -> Condition (comparten el mismo lock)
+        self._versiones = {}   # user_id -> contador de avisos
+        self._streams = 0
+
+    def _condicion(self, user_id):
+        if user_id not in self._condiciones:
+            self._condiciones[user_id] = threading.Condition(self._lock)
+        return self._condiciones[user_id]
+
+    def version(self, user_id):
+        with self._lock:
+            return self._versiones.get(user_id, 0)
+
+    def avisar(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._versiones[user_id] = self._versiones.get(user_id, 0) + 1
+                self._condicion(user_id).notify_all()
+
+    def esperar(self, user_id, version, timeout):
+        """Bloquea hasta un aviso posterior a `version` o hasta `timeout`. Devuelve la versión actual."""
+        with self._lock:
+            self._condicion(user_id).wait_for(lambda: self._versiones.get(user_id, 0) != version, timeout)
+            return self._versiones.get(user_id, 0)
+
+    def abrir_stream(self, maximo):
+        with self._lock:
+            if self._streams >= maximo:
+                return False
+            self._streams += 1
+            return True
+
+    def cerrar_stream(self):
+        with self._lock:
+            self._streams -= 1
+
+avisos_mensajes = AvisosMensajes()
+
+@event.listens_for(db.session, 'after_flush')
+def _registrar_mensajes_nuevos(session, flush_context):
+    nuevos = {obj.user_id for obj in session.new if isinstance(obj, MensajeAsistente) and not obj.leido}
+    if nuevos:
+        session.info.setdefault('mensajes_nuevos', set()).update(nuevos)
+
+@event.listens_for(db.session, 'after_commit')
+def _avisar_mensajes_nuevos(session):
+    nuevos = session.info.pop('mensajes_nuevos', None)
+    if nuevos:
+        avisos_mensajes.avisar(nuevos)
+
+@event.listens_for(db.session, 'after_rollback')
+def _descartar_mensajes_nuevos(session):
+    session.info.pop('mensajes_nuevos', None)
+
+def _entregar_mensajes(user_id, despues_de=None):
+    """
+    Devuelve (mensajes, ultimo_id) con los mensajes no leídos del usuario (sólo los de
+    id > `despues_de` si se indica), y los marca como leídos sin cargar objetos ORM.
+    En Postgres lectura y acuse son UN UPDATE ... RETURNING; en el resto, un SELECT sobre
+    ix_mensaje_asistente_user_leido_ts y un UPDATE por rango de ids.
+    """
+    no_leidos = [MensajeAsistente.user_id == user_id, MensajeAsistente.leido == False]
+    if despues_de is not None:
+        no_leidos.append(MensajeAsistente.id > despues_de)
+    columnas = (MensajeAsistente.id, MensajeAsistente.contenido, MensajeAsistente.timestamp)
+    sin_sincronizar = {'synchronize_session': False}
+
+    if db.engine.dialect.update_returning:
+        filas = db.session.execute(
+            db.update(MensajeAsistente).where(*no_leidos).values(leido=True).returning(*columnas),
+            execution_options=sin_sincronizar
+        ).all()
+        filas.sort(key=lambda fila: (fila.timestamp, fila.id)) # RETURNING no garantiza orden
+    else:
+        filas = db.session.execute(
+            db.select(*columnas).where(*no_leidos).order_by(MensajeAsistente.timestamp, MensajeAsistente.id)
+        ).all()
+        if filas:
+            db.session.execute(
+                db.update(MensajeAsistente)
+                .where(*no_leidos, MensajeAsistente.id <= max(fila.id for fila in filas))
+                .values(leido=True),
+                execution_options=sin_sincronizar
+            )
+    if filas:
+        db.session.commit()
+
+    data = [
+        {'id': fila.id, 'contenido': fila.contenido, 'timestamp': fila.timestamp.isoformat()}
+        for fila in filas
+    ]
+    ultimo_id = max((fila.id for fila in filas), default=despues_de)
+    return data, ultimo_id
+
+def _stream_mensajes_asistente(user_id, ultimo_id):
+    """
+    Generador SSE: envía los mensajes pendientes y luego espera avisos sin tocar la BD.
+    La conexión a la BD se devuelve al pool entre consultas; tras ASISTENTE_STREAM_SEGUNDOS
+    el stream termina y el navegador reconecta solo, enviando Last-Event-ID.
+    El cupo del stream lo libera la respuesta al cerrarse (ver asistente_stream).
+    """
+    fin = monotonic() + app.config['ASISTENTE_STREAM_SEGUNDOS']
+    sondeo = app.config['ASISTENTE_STREAM_SONDEO']
+    try:
+        yield "retry: 3000\n\n"
+        mensajes, ultimo_id = _entregar_mensajes(user_id, ultimo_id)
+
+        version = avisos_mensajes.version(user_id)
+        while True:
+            db.session.close() # No retener la conexión mientras se espera
+            for msg in mensajes:
+                yield f"id: {msg['id']}\ndata: {json.dumps(msg)}\n\n"
+
+            restante = fin - monotonic()
+            if restante <= 0:
+                break
+            nueva_version = avisos_mensajes.esperar(user_id, version, min(sondeo, restante))
+            if nueva_version == version:
+                yield ": ping\n\n" # Mantiene viva la conexión a través de proxies
+            version = nueva_version
+            mensajes, ultimo_id = _entregar_mensajes(user_id, ultimo_id)
+    finally:
+        db.session.close()
+
+@app.route('/api/asistente/stream')
+@login_required
+def asistente_stream():
+    """Canal SSE con los mensajes nuevos del asistente (reporte diario, avisos del cron, etc.)."""
+    if not app.config['ASISTENTE_SSE'] or not avisos_mensajes.abrir_stream(app.config['ASISTENTE_STREAMS_MAX']):
+        abort(503) # El cliente pasa al sondeo de /api/get_mensajes_asistente
+
+    try:
+        ultimo_id = request.headers.get('Last-Event-ID', type=int)
+        user_id = current_user.id
+        db.session.close()
+        respuesta = Response(
+            stream_with_context(_stream_mensajes_asistente(user_id, ultimo_id)),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+    except Exception:
+        avisos_mensajes.cerrar_stream()
+        raise
+    # El servidor cierra la respuesta aunque el generador nunca llegue a iterarse
+    # (cliente que se desconecta antes del primer fragmento, error al enviar las cabeceras)
+    respuesta.call_on_close(avisos_mensajes.cerrar_stream)
+    return respuesta
+
+def _prompt_chat_asistente(user, personalidad_prompt, mensaje):
+    return textwrap.dedent(f"""
+    **Rol:** {personalidad_prompt}
+    **Usuario:** {user.username} (Nivel {user.nivel}, Salud {user.vida}%)
+    - Metas Personales: {user.metas_personales}
+    - Metas Profesionales: {user.metas_profesionales}
+    **Mensaje del usuario:** {mensaje}
+    **Tarea:** Responde al usuario con tu personalidad, en español y en máximo 120 palabras.
+    """)
+
+def _stream_chat_asistente(user_id, primero, fragmentos):
+    """Reenvía la respuesta de Gemini fragmento a fragmento y, al terminar, la guarda como mensaje."""
+    partes = [primero]
+    yield primero
+    try:
+        for fragmento in fragmentos:
+            partes.append(fragmento)
+            yield fragmento
+    except ErrorIA as e:
+        app.logger.error(f"Chat del asistente interrumpido para user_id={user_id}: {e}")
+        yield "\n(La respuesta se interrumpió. Inténtalo de nuevo.)"
+        return
+
+    # Ya se mostró en el chat: se guarda como leído para que el SSE no la vuelva a enviar
+    db.session.add(MensajeAsistente(user_id=user_id, contenido="".join(partes), leido=True))
+    db.session.commit()
+
+@app.route('/api/asistente/chat', methods=['POST'])
+@login_required
+def asistente_chat():
+    """
+    Responde a un mensaje del usuario con la personalidad de su asistente, enviando
+    la respuesta de Gemini a medida que se genera (text/plain en streaming).
+    """
+    # Sólo JSON: un formulario de otro sitio no puede enviarlo sin preflight CORS
+    data = request.get_json(silent=True)
+    mensaje = data.get('mensaje') if isinstance(data, dict) else None
+    if not isinstance(mensaje, str) or not mensaje.strip():
+        return jsonify({'error': 'Escribe un mensaje.'}), 400
+    mensaje = mensaje.strip()[:1000]
+
+    personalidad = AsistentePersonalidad.query.filter_by(nombre=current_user.asistente_persona).first()
+    personalidad_prompt = personalidad.prompt_descripcion if personalidad else "Eres un asistente amigable."
+    prompt = _prompt_chat_asistente(current_user, personalidad_prompt, mensaje)
+    user_id = current_user.id
+    db.session.close() # No retener la conexión mientras Gemini responde
+
+    # Se espera el primer fragmento aquí para poder responder con un error HTTP si Gemini falla
+    fragmentos = _gemini_stream(prompt)
+    try:
+        primero = next(fragmentos, "")
+    except ErrorIA as e:
+        app.logger.error(f"Error en chat del asistente: {e}")
+        return jsonify({'error': 'El asistente no está disponible en este momento.'}), 503
+
+    return Response(
+        stream_with_context(_stream_chat_asistente(user_id, primero, fragmentos)),
+        mimetype='text/plain',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/api/get_mensajes_asistente')
+@presupuesto_sql(4)
 @login_required
 def get_mensajes_asistente():
-    """Obtiene todos los mensajes no leídos del asistente para el chat."""
-    mensajes = MensajeAsistente.query.filter_by(
-        user_id=current_user.id, 
-        leido=False
-    ).order_by(MensajeAsistente.timestamp.asc()).all()
-    
-    data = []
-    for msg in mensajes:
-        data.append({
-            'contenido': msg.contenido,
-            'timestamp': msg.timestamp.isoformat()
-        })
-        msg.leido = True 
-    
-    db.session.commit()
-    return jsonify(data)
+    """
+    Obtiene los mensajes no leídos del asistente para el chat (sondeo, alternativa al SSE).
+    Con `despues_de` devuelve sólo los posteriores a ese id; si no hay nada nuevo y el
+    If-None-Match coincide, responde 304 sin cuerpo. Lo habitual (nada nuevo) cuesta una
+    consulta indexada: el acuse (UPDATE) sólo corre si hay mensajes que entregar.
+    """
+    despues_de = request.args.get('despues_de', type=int)
+    user_id = current_user.id
+    nuevos = [MensajeAsistente.user_id == user_id, MensajeAsistente.leido == False]
+    if despues_de is not None:
+        nuevos.append(MensajeAsistente.id > despues_de)
+    if db.session.execute(db.select(db.exists().where(*nuevos))).scalar():
+        data, ultimo_id = _entregar_mensajes(user_id, despues_de)
+    else:
+        data, ultimo_id = [], despues_de
+
+    etag = f'"m-{ultimo_id or 0}"'
+    if not data and etag in request.headers.get('If-None-Match', ''):
+        return Response(status=304, headers={'ETag': etag})
+
+    respuesta = jsonify(data)
+    respuesta.headers['ETag'] = etag
+    respuesta.headers['Cache-Control'] = 'no-cache'
+    return respuesta
 
 # === Funciones Helper de IA (Lógica de Negocio) ===
 
-def _get_gemini_response(prompt_text, want_json=False):
-    """Función helper para llamar a Gemini."""
-    if not GEMINI_API_KEY:
-        app.logger.error("GEMINI_API_KEY no está configurada.")
-        return "Error: La API de IA no está configurada."
+GEMINI_MODELO = "gemini-2.5-flash"
+
+class ErrorIA(Exception):
+    """Error base de las llamadas a la IA."""
+
+class IANoConfiguradaError(ErrorIA):
+    """No hay GEMINI_API_KEY configurada."""
+
+class IANoDisponibleError(ErrorIA):
+    """Gemini está caído o saturado (429/5xx/timeout) y se agotaron los reintentos."""
+
+class IACircuitoAbiertoError(IANoDisponibleError):
+    """El circuit breaker está abierto: no se llama a Gemini hasta que pase el tiempo de espera."""
+
+class IAPeticionError(ErrorIA):
+    """Gemini rechazó la petición o devolvió una respuesta inutilizable. Reintentar no sirve."""
+
+# Errores de Gemini que merece la pena reintentar
+ERRORES_GEMINI_REINTENTABLES = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.TooManyRequests,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.BadGateway,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.GatewayTimeout,
+    ConnectionError,
+    TimeoutError,
+)
+
+class LimitadorTasa:
+    """Token bucket compartido entre hilos: `tasa` peticiones por segundo con ráfagas de hasta `capacidad`."""
+
+    def __init__(self, tasa, capacidad):
+        self.tasa = tasa
+        self.capacidad = capacidad
+        self._tokens = float(capacidad)
+        self._ultimo = monotonic()
+        self._lock = threading.Lock()
+
+    def adquirir(self):
+        """Bloquea hasta que haya un token disponible."""
+        while True:
+            with self._lock:
+                ahora = monotonic()
+                self._tokens = min(self.capacidad, self._tokens + (ahora - self._ultimo) * self.tasa)
+                self._ultimo = ahora
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                espera = (1 - self._tokens) / self.tasa
+            sleep(espera)
+
+class InterruptorCircuito:
+    """
+    Circuit breaker: tras `umbral` fallos seguidos se abre y rechaza llamadas durante
+    `segundos_abierto`. Luego deja pasar una llamada de prueba (semiabierto).
+    """
+
+    def __init__(self, umbral, segundos_abierto):
+        self.umbral = umbral
+        self.segundos_abierto = segundos_abierto
+        self._fallos = 0
+        self._abierto_desde = None
+        self._prueba_en_curso = False
+        self._lock = threading.Lock()
+
+    @property
+    def estado(self):
+        with self._lock:
+            if self._abierto_desde is None:
+                return 'cerrado'
+            if monotonic() - self._abierto_desde < self.segundos_abierto:
+                return 'abierto'
+            return 'semiabierto'
+
+    def permitir(self):
+        with self._lock:
+            if self._abierto_desde is None:
+                return True
+            if monotonic() - self._abierto_desde < self.segundos_abierto or self._prueba_en_curso:
+                return False
+            self._prueba_en_curso = True
+            return True
+
+    def registrar_exito(self):
+        with self._lock:
+            self._fallos = 0
+            self._abierto_desde = None
+            self._prueba_en_curso = False
+
+    def registrar_fallo(self):
+        with self._lock:
+            self._fallos += 1
+            if self._prueba_en_curso or self._fallos >= self.umbral:
+                self._abierto_desde = monotonic()
+            self._prueba_en_curso = False
+
+class ClienteGemini:
+    """
+    Cliente reutilizable de Gemini: cachea los modelos por (modelo, config), respeta el
+    límite de peticiones, reintenta con backoff exponencial + jitter los errores transitorios
+    y corta las llamadas mientras Gemini está caído.
+    """
+
+    def __init__(self, api_key, limitador, interruptor, max_reintentos, espera_base, espera_max):
+        self.api_key = api_key
+        self.limitador = limitador
+        self.interruptor = interruptor
+        self.max_reintentos = max_reintentos
+        self.espera_base = espera_base
+        self.espera_max = espera_max
+        self._modelos = {}
+        self._modelos_lock = threading.Lock()
+
+    def modelo(self, nombre, generation_config=None):
+        clave = (nombre, json.dumps(generation_config, sort_keys=True))
+        with self._modelos_lock:
+            model = self._modelos.get(clave)
+            if model is None:
+                if generation_config:
+                    model = genai.GenerativeModel(model_name=nombre, generation_config=generation_config)
+                else:
+                    model = genai.GenerativeModel(model_name=nombre)
+                self._modelos[clave] = model
+            return model
+
+    def _espera(self, intento):
+        """Backoff exponencial con jitter completo."""
+        return random.uniform(0, min(self.espera_max, self.espera_base * (2 ** intento)))
+
+    def _con_reintentos(self, llamada):
+        """Ejecuta `llamada()` respetando circuito, límite y reintentos. Lanza una subclase de ErrorIA."""
+        if not self.api_key:
+            raise IANoConfiguradaError("La API de IA no está configurada.")
+
+        for intento in range(self.max_reintentos + 1):
+            if not self.interruptor.permitir():
+                raise IACircuitoAbiertoError("Gemini no está disponible (circuito abierto).")
+            self.limitador.adquirir()
+            try:
+                resultado = llamada()
+            except ERRORES_GEMINI_REINTENTABLES as e:
+                self.interruptor.registrar_fallo()
+                if intento == self.max_reintentos:
+                    raise IANoDisponibleError(f"Gemini no respondió tras {intento + 1} intento(s): {e}") from e
+                espera = self._espera(intento)
+                app.logger.warning(f"Error transitorio de Gemini ({type(e).__name__}), reintento en {espera:.1f}s")
+                sleep(espera)
+                continue
+            except Exception as e:
+                # La petición llegó y Gemini respondió: el servicio está vivo aunque la respuesta no sirva
+                self.interruptor.registrar_exito()
+                raise IAPeticionError(f"Gemini rechazó la petición: {e}") from e
+            self.interruptor.registrar_exito()
+            return resultado
+
+    def generar(self, prompt_text, nombre=GEMINI_MODELO, generation_config=None):
+        """Devuelve el texto generado o lanza una subclase de ErrorIA."""
+        model = self.modelo(nombre, generation_config)
+        return self._con_reintentos(lambda: model.generate_content(prompt_text).text)
+
+    def generar_stream(self, prompt_text, nombre=GEMINI_MODELO, generation_config=None):
+        """
+        Como `generar`, pero va devolviendo los fragmentos de texto a medida que Gemini los produce.
+        Sólo se reintenta hasta recibir el primer fragmento; después, un error corta el stream.
+        """
+        model = self.modelo(nombre, generation_config)
+
+        def abrir_stream():
+            fragmentos = iter(model.generate_content(prompt_text, stream=True))
+            primero = next(fragmentos, None)
+            return fragmentos, (primero.text if primero is not None else "")
+
+        fragmentos, primero = self._con_reintentos(abrir_stream)
+        if primero:
+            yield primero
+        try:
+            for fragmento in fragmentos:
+                if fragmento.text:
+                    yield fragmento.text
+        except ERRORES_GEMINI_REINTENTABLES as e:
+            self.interruptor.registrar_fallo()
+            raise IANoDisponibleError(f"Gemini cortó la respuesta: {e}") from e
+        except Exception as e:
+            raise IAPeticionError(f"Gemini rechazó la petición: {e}") from e
+
+cliente_gemini = ClienteGemini(
+    api_key=GEMINI_API_KEY,
+    limitador=LimitadorTasa(app.config['GEMINI_PETICIONES_POR_SEGUNDO'], app.config['GEMINI_RAFAGA']),
+    interruptor=InterruptorCircuito(app.config['GEMINI_CIRCUITO_UMBRAL'], app.config['GEMINI_CIRCUITO_SEGUNDOS']),
+    max_reintentos=app.config['GEMINI_MAX_REINTENTOS'],
+    espera_base=app.config['GEMINI_ESPERA_BASE'],
+    espera_max=app.config['GEMINI_ESPERA_MAX'],
+)
+
+class _CacheLRU:
+    """Caché en memoria acotada: al superar `max_entradas` se descarta la usada hace más tiempo."""
+
+    def __init__(self, max_entradas):
+        self.max_entradas = max_entradas
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, clave):
+        with self._lock:
+            valor = self._datos.get(clave)
+            if valor is not None:
+                self._datos.move_to_end(clave)
+            return valor
+
+    def set(self, clave, valor):
+        with self._lock:
+            self._datos[clave] = valor
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+
+    def __len__(self):
+        return len(self._datos)
+
+_cache_ia_memoria = _CacheLRU(app.config['IA_CACHE_MAX_ENTRADAS'])
+_cache_feed = _CacheLRU(app.config['FEED_CACHE_MAX_ENTRADAS']) # Páginas del feed por (versión, cursor)
+_estadisticas_cache_ia = {'hits_memoria': 0, 'hits_bd': 0, 'fallos': 0, 'escrituras': 0}
+_estadisticas_cache_ia_lock = threading.Lock()
+
+def _contar_cache_ia(evento):
+    with _estadisticas_cache_ia_lock:
+        _estadisticas_cache_ia[evento] += 1
+
+def estadisticas_cache_ia():
+    """Contadores de aciertos/fallos de la caché de la IA (por proceso)."""
+    with _estadisticas_cache_ia_lock:
+        datos = dict(_estadisticas_cache_ia)
+    consultas = datos['hits_memoria'] + datos['hits_bd'] + datos['fallos']
+    datos['entradas_memoria'] = len(_cache_ia_memoria)
+    datos['tasa_aciertos'] = round((datos['hits_memoria'] + datos['hits_bd']) / consultas, 4) if consultas else 0.0
+    return datos
+
+def _clave_cache_ia(modelo, generation_config, prompt_text):
+    """Clave de caché: modelo + config de generación + prompt con los espacios normalizados."""
+    prompt_normalizado = " ".join(prompt_text.split())
+    material = json.dumps([modelo, generation_config or {}, prompt_normalizado], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+def _leer_cache_ia(clave):
+    """Busca una respuesta vigente: primero en memoria y luego en la BD."""
+    ttl = timedelta(hours=app.config['IA_CACHE_TTL_HORAS'])
+    entrada = _cache_ia_memoria.get(clave)
+    if entrada is not None and datetime.utcnow() - entrada[1] < ttl:
+        _contar_cache_ia('hits_memoria')
+        return entrada[0]
+
     try:
-        if want_json:
-            model = genai.GenerativeModel(
-                model_name="gemini-2.5-flash",
-                generation_config={"response_mime_type": "application/json"}
-            )
-        else:
-            model = genai.GenerativeModel(model_name="gemini-2.5-flash")
-            
-        response = model.generate_content(prompt_text)
-        
-        if want_json:
-            cleaned_response = response.text.strip().replace("```json", "").replace("```", "")
-            return cleaned_response
-        else:
-            return response.text
-            
+        # Conexión propia para no mezclar la caché con la transacción de quien llama
+        with db.engine.connect() as conn:
+            fila = conn.execute(
+                db.select(RespuestaIACache.respuesta, RespuestaIACache.creado)
+                .where(RespuestaIACache.clave == clave)
+            ).first()
+    except Exception as e:
+        app.logger.warning(f"No se pudo leer la caché de IA en BD: {e}")
+        fila = None
+
+    if fila is not None and datetime.utcnow() - fila.creado < ttl:
+        _cache_ia_memoria.set(clave, (fila.respuesta, fila.creado))
+        _contar_cache_ia('hits_bd')
+        return fila.respuesta
+
+    _contar_cache_ia('fallos')
+    return None
+
+def _guardar_cache_ia(clave, modelo, respuesta):
+    ahora = datetime.utcnow()
+    _cache_ia_memoria.set(clave, (respuesta, ahora))
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(db.delete(RespuestaIACache).where(RespuestaIACache.clave == clave))
+            conn.execute(db.insert(RespuestaIACache).values(clave=clave, modelo=modelo, respuesta=respuesta, creado=ahora))
+        _contar_cache_ia('escrituras')
     except Exception as e:
+        app.logger.warning(f"No se pudo guardar la caché de IA en BD: {e}")
+
+def _purgar_cache_ia():
+    """Borra de la BD las respuestas cuya vigencia ya expiró. Devuelve cuántas se borraron."""
+    limite = datetime.utcnow() - timedelta(hours=app.config['IA_CACHE_TTL_HORAS'])
+    resultado = db.session.execute(db.delete(RespuestaIACache).where(RespuestaIACache.creado < limite))
+    db.session.commit()
+    return resultado.rowcount
+
+def _registrar_llamada_gemini(inicio, resultado, error=None, respuesta=None):
+    """Métricas de una llamada a Gemini que empezó en `inicio` (monotonic)."""
+    if not app.config['METRICAS_ACTIVAS']:
+        return
+    metricas.observar('progreso_gemini_segundos', monotonic() - inicio, resultado=resultado)
+    metricas.contar('progreso_gemini_llamadas_total', resultado=resultado)
+    if error is not None:
+        metricas.contar('progreso_gemini_errores_total', clase=type(error).__name__)
+    if respuesta is not None:
+        metricas.observar('progreso_gemini_respuesta_bytes', len(respuesta.encode('utf-8')))
+
+def _gemini_stream(prompt_text):
+    """
+    `cliente_gemini.generar_stream` con las mismas métricas que _get_gemini_response. La latencia
+    llega hasta el último fragmento; un stream que el cliente abandona cuenta como 'cancelada'.
+    """
+    if app.config['METRICAS_ACTIVAS']:
+        metricas.observar('progreso_gemini_prompt_bytes', len(prompt_text.encode('utf-8')))
+    inicio = monotonic()
+    partes = []
+    resultado, error = 'cancelada', None
+    try:
+        for fragmento in cliente_gemini.generar_stream(prompt_text):
+            partes.append(fragmento)
+            yield fragmento
+        resultado = 'ok'
+    except ErrorIA as e:
+        resultado, error = 'error', e
+        raise
+    finally:
+        _registrar_llamada_gemini(inicio, resultado, error=error, respuesta=None if error else "".join(partes))
+
+def _get_gemini_response(prompt_text, want_json=False, usar_cache=False):
+    """
+    Función helper para llamar a Gemini. Devuelve el texto o lanza una subclase de ErrorIA.
+    Con `usar_cache=True` se reutiliza una respuesta idéntica reciente (memoria o BD).
+    """
+    generation_config = {"response_mime_type": "application/json"} if want_json else None
+    clave = None
+    if usar_cache:
+        clave = _clave_cache_ia(GEMINI_MODELO, generation_config, prompt_text)
+        respuesta_cache = _leer_cache_ia(clave)
+        if respuesta_cache is not None:
+            if app.config['METRICAS_ACTIVAS']:
+                metricas.contar('progreso_gemini_llamadas_total', resultado='cache')
+            return respuesta_cache
+
+    if app.config['METRICAS_ACTIVAS']:
+        metricas.observar('progreso_gemini_prompt_bytes', len(prompt_text.encode('utf-8')))
+    inicio = monotonic()
+    try:
+        respuesta = cliente_gemini.generar(prompt_text, GEMINI_MODELO, generation_config)
+    except ErrorIA as e:
         app.logger.error(f"Error en llamada a Gemini: {e}")
-        return "Error al contactar a la IA."
+        _registrar_llamada_gemini(inicio, 'error', error=e)
+        raise
+    _registrar_llamada_gemini(inicio, 'ok', respuesta=respuesta)
+
+    if want_json:
+        respuesta = respuesta.strip().replace("```json", "").replace("```", "")
+
+    if clave is not None:
+        try:
+            if want_json:
+                json.loads(respuesta) # Nunca se cachea un JSON que no se puede leer
+            _guardar_cache_ia(clave, GEMINI_MODELO, respuesta)
+        except ValueError:
+            pass
+    return respuesta
 
 
 def _generar_setup_ia_logic(user):
@@ -783,266 +2351,1095 @@ def _generar_setup_ia_logic(user):
     return _get_gemini_response(prompt, want_json=True)
 
 
-# --- Lógica de Tareas Programadas (Cron) ---
+def _persistir_setup_ia(user, data):
+    """Crea las Áreas, Hábitos e Items de Tienda del setup inicial a partir del JSON de la IA."""
+    # 1. Crear Áreas de Vida
+    areas_map = {}
+    for area in data.get('areas_vida', []):
+        nueva_area = AreaVida(
+            nombre=area.get('nombre'),
+            icono_svg=area.get('icono_svg', 'icono-default'),
+            autor=user
+        )
+        db.session.add(nueva_area)
+        db.session.flush() 
+        areas_map[area.get('nombre')] = nueva_area.id
 
-USER_TZ = pytz.timezone('America/Bogota') # Zona horaria de Colombia
-HORA_GENERACION = 6 # 6:00 AM
-HORA_VERIFICACION = 18 # 6:00 PM
-HORA_REPORTE = 21 # 9:00 PM
+    # 2. Crear Hábitos
+    for habito in data.get('habitos', []):
+        area_id = areas_map.get(habito.get('area_nombre'))
+        nuevo_habito = Habito(
+            titulo=habito.get('titulo'),
+            recompensa_xp=habito.get('recompensa_xp', 10),
+            recompensa_pesos=habito.get('recompensa_pesos', 1000),
+            penalizacion_vida=habito.get('penalizacion_vida', 5),
+            autor=user,
+            area_id=area_id
+        )
+        db.session.add(nuevo_habito)
+    db.session.flush()
+    _sumar_contadores_areas('num_habitos', Counter(
+        areas_map.get(habito.get('area_nombre')) for habito in data.get('habitos', [])
+    ))
+
+    # 3. Crear Items de Tienda Personalizados (Lote Inicial)
+    for item in data.get('recompensas_tienda', []):
+        nuevo_item = TiendaItem(
+            nombre=item.get('nombre'),
+            costo_pesos=item.get('costo_pesos', 10000),
+            autor=user
+        )
+        db.session.add(nuevo_item)
 
-def _generar_misiones_diarias_logic():
+def _reclamar_setup_ia(user_id):
     """
-    Lógica para el Cron Job 1.
-    Genera nuevas misiones diarias para cada usuario.
+    Marca el setup como 'generando' sólo si nadie lo está generando ya (UPDATE condicional).
+    También se reclama un 'generando' abandonado y un 'listo' que no dejó áreas.
+    Devuelve True si esta petición ganó el derecho a lanzarlo.
     """
-    app.logger.info("Iniciando lógica de Cron: Generar Misiones Diarias...")
-    users = User.query.filter(User.metas_personales != None).all() 
-    
-    for user in users:
-        app.logger.info(f"Generando {user.ai_misiones_por_dia} misión(es) para: {user.username}")
+    ahora = datetime.utcnow()
+    abandonado = ahora - timedelta(minutes=app.config['SETUP_IA_MINUTOS_MAX'])
+    resultado = db.session.execute(
+        db.update(User)
+        .where(
+            User.id == user_id,
+            db.or_(
+                User.setup_estado == None,
+                User.setup_estado == 'error',
+                db.and_(
+                    User.setup_estado == 'generando',
+                    db.or_(User.setup_iniciado == None, User.setup_iniciado < abandonado)
+                ),
+                db.and_(User.setup_estado == 'listo', ~db.exists().where(AreaVida.user_id == User.id))
+            )
+        )
+        .values(setup_estado='generando', setup_iniciado=ahora)
+    )
+    db.session.commit()
+    return resultado.rowcount == 1
+
+def _generar_setup_usuario(user, payload=None):
+    """Genera y guarda el setup inicial de un usuario. Idempotente: si ya tiene áreas no hace nada."""
+    if user.areas:
+        user.setup_estado = 'listo'
+        db.session.commit()
+        return
+
+    try:
+        ai_response = _generar_setup_ia_logic(user)
+        data = json.loads(ai_response)
+        if not isinstance(data, dict) or not data.get('areas_vida'):
+            raise ValueError("La IA no devolvió áreas de vida para el setup.")
+        _persistir_setup_ia(user, data)
+        user.setup_estado = 'listo'
+        db.session.commit() # Datos y estado en la misma transacción
+        app.logger.info(f"Generación de IA completada para: {user.email}")
+    except Exception:
+        db.session.rollback()
+        user.setup_estado = 'error'
+        db.session.commit()
+        raise
+
+def _setup_ia_en_fondo(user_id):
+    with app.app_context():
+        user = db.session.get(User, user_id)
+        if user is None:
+            return
         try:
-            metas = f"Personales: {user.metas_personales}\nProfesionales: {user.metas_profesionales}"
-            areas = AreaVida.query.filter_by(autor=user).all()
-            if not areas:
-                app.logger.warning(f"Usuario {user.username} no tiene áreas de vida. Saltando.")
-                continue
-            
-            nombres_areas = ", ".join([a.nombre for a in areas])
-            cantidad_misiones = user.ai_misiones_por_dia
-
-            prompt = textwrap.dedent(f"""
-            **Rol:** Eres "ProgreSO", un coach de IA.
-            **Perfil del Usuario:**
-            - Metas Principales: {metas}
-            - Áreas de Enfoque: {nombres_areas}
-            **Tarea:** Genera exactamente {cantidad_misiones} misión(es) diaria(s), pequeña(s) y accionable(s), que ayuden al usuario a avanzar en sus metas.
-            
-            **Formato de Salida:** Responde ÚNICAMENTE con un objeto JSON.
-            Si {cantidad_misiones} == 1, responde con un objeto:
-            {{"titulo": "...", "area_nombre": "...", "recompensa_pesos": 5000}}
-            
-            Si {cantidad_misiones} > 1, responde con una LISTA de objetos:
-            [
-              {{"titulo": "Misión 1", "area_nombre": "Área 1", "recompensa_pesos": 5000}},
-              {{"titulo": "Misión 2", "area_nombre": "Área 2", "recompensa_pesos": 3000}}
-            ]
-            
-            **Reglas:**
-            - "area_nombre" debe ser un nombre EXACTO de la lista de Áreas de Enfoque.
-            """)
-            
-            response_json = _get_gemini_response(prompt, want_json=True)
-            if "Error" in response_json:
-                raise Exception(response_json)
-                
-            data = json.loads(response_json)
-            
-            # Normalizar la respuesta de la IA (sea un objeto o una lista)
-            if isinstance(data, list):
-                misiones_data = data
-            elif isinstance(data, dict):
-                misiones_data = [data]
-            else:
-                raise Exception("Respuesta de IA no tiene el formato esperado (ni lista ni objeto)")
-
-            now_user_tz = datetime.now(USER_TZ)
-            plazo_local = now_user_tz.replace(hour=HORA_VERIFICACION, minute=0, second=0, microsecond=0)
-            plazo_utc = plazo_local.astimezone(pytz.utc)
-
-            for mision_data in misiones_data:
-                area_mision = AreaVida.query.filter_by(autor=user, nombre=mision_data.get('area_nombre')).first()
-                area_id = area_mision.id if area_mision else None
-
-                nueva_mision = Mision(
-                    titulo=mision_data.get('titulo', 'Misión Diaria (Error IA)'),
-                    recompensa_xp=50,
-                    recompensa_pesos=mision_data.get('recompensa_pesos', 5000),
-                    plazo=plazo_utc,
-                    user_id=user.id,
-                    area_id=area_id
-                )
-                db.session.add(nueva_mision)
-            
-            db.session.commit() # Commit una vez por usuario
+            _generar_setup_usuario(user)
+        except Exception as e:
+            app.logger.error(f"Error fatal en 'generar_setup_ia' para {user.email}: {e}")
+
+_ejecutor_setup_ia = ThreadPoolExecutor(max_workers=app.config['SETUP_IA_HILOS'], thread_name_prefix='setup-ia')
+
+def _lanzar_setup_ia(user_id):
+    """Encola el setup en la cola de BD si está activa; si no, lo corre en un hilo de este proceso."""
+    if app.config['CRON_USAR_COLA']:
+        _encolar_tareas('setup_ia', [user_id])
+    else:
+        _ejecutor_setup_ia.submit(_setup_ia_en_fondo, user_id)
 
+
+# --- Lógica de Tareas Programadas (Cron) ---
+
+USER_TZ = pytz.timezone('America/Bogota') # Zona horaria de Colombia
+HORA_GENERACION = 6 # 6:00 AM
+HORA_VERIFICACION = 18 # 6:00 PM
+HORA_REPORTE = 21 # 9:00 PM
+
+def _filtro_shard(columna_user_id, shard=None, num_shards=None):
+    """Condiciones para quedarse con la partición `shard` de `num_shards` (user_id % num_shards)."""
+    if not num_shards or num_shards <= 1:
+        return []
+    return [columna_user_id % num_shards == shard]
+
+def _iterar_bloques_usuarios(*filtros, shard=None, num_shards=None, tamano_bloque=None):
+    """
+    Recorre los usuarios que cumplen `filtros` en bloques paginados por id (keyset),
+    sin cargar toda la tabla en memoria. Con `num_shards` sólo recorre su partición.
+    """
+    tamano_bloque = tamano_bloque or app.config['CRON_TAMANO_BLOQUE']
+    condiciones = list(filtros) + _filtro_shard(User.id, shard, num_shards)
+    ultimo_id = 0
+    while True:
+        bloque = (
+            User.query.filter(User.id > ultimo_id, *condiciones)
+            .order_by(User.id)
+            .limit(tamano_bloque)
+            .all()
+        )
+        if not bloque:
+            break
+        ultimo_id = bloque[-1].id
+        _contar_cron('progreso_cron_usuarios_total', len(bloque))
+        yield bloque
+
+def _procesar_usuario_aislado(user, procesar, descripcion):
+    """
+    Ejecuta `procesar(user)` aislando sus errores: un fallo sólo revierte a ese usuario.
+    Devuelve el resultado de `procesar`, o None si falló.
+    """
+    try:
+        return procesar(user)
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Error {descripcion} para {user.username}: {e}")
+        _contar_cron('progreso_cron_fallos_total')
+        return None
+
+def _registrar_grupo_fallido(ids, error, fallidos):
+    """Un grupo falló fuera de su aislamiento por usuario: se revierte, se registra y se cuenta."""
+    db.session.rollback()
+    app.logger.error(f"Error procesando el grupo de user_id={ids}: {error}")
+    _contar_cron('progreso_cron_fallos_total', len(ids))
+    fallidos.append(ids)
+
+def _avisar_grupos_fallidos(fallidos, total):
+    if fallidos:
+        app.logger.warning(
+            f"{len(fallidos)} de {total} grupo(s) fallaron ({sum(len(ids) for ids in fallidos)} usuario(s) sin procesar)."
+        )
+
+def _worker_grupos(cola_grupos, procesar_grupo, resultados, fallidos):
+    """
+    Hilo de trabajo de un Cron Job concurrente. Abre su propio contexto de app,
+    y por tanto una única sesión de BD, que reutiliza para todos los grupos que toma de la cola.
+    Lo que devuelve cada grupo se acumula en `resultados` (datos planos, no objetos ORM); los ids
+    de un grupo que lanza una excepción van a `fallidos` y el hilo sigue vaciando la cola.
+    """
+    with app.app_context():
+        while True:
+            try:
+                ids = cola_grupos.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                users = User.query.filter(User.id.in_(ids)).order_by(User.id).all()
+                if users:
+                    resultados.extend(procesar_grupo(users) or [])
+            except Exception as e:
+                _registrar_grupo_fallido(ids, e, fallidos)
+
+def _ejecutar_en_grupos(users, procesar_grupo, concurrencia=None, tamano_grupo=1):
+    """
+    Reparte los usuarios en grupos de `tamano_grupo` y aplica `procesar_grupo(grupo)` a cada uno.
+    Con concurrencia > 1 los grupos se atienden en hilos, de modo que la construcción
+    de prompts y las llamadas a Gemini corren en paralelo.
+    Devuelve la concatenación de lo que devolvió cada grupo. Un grupo que lanza una excepción se
+    registra como fallido (log y progreso_cron_fallos_total) sin detener a los demás.
+    """
+    tamano_grupo = max(1, tamano_grupo or 1)
+    grupos = [users[i:i + tamano_grupo] for i in range(0, len(users), tamano_grupo)]
+    resultados = []
+    fallidos = []
+
+    if concurrencia is None:
+        concurrencia = app.config['CRON_CONCURRENCIA']
+    concurrencia = max(1, min(concurrencia, app.config['CRON_CONCURRENCIA_MAX'], len(grupos) or 1))
+
+    if concurrencia == 1:
+        for grupo in grupos:
+            ids = [user.id for user in grupo]
+            try:
+                resultados.extend(procesar_grupo(grupo) or [])
+            except Exception as e:
+                _registrar_grupo_fallido(ids, e, fallidos)
+        _avisar_grupos_fallidos(fallidos, len(grupos))
+        return resultados
+
+    # Los hilos sólo reciben ids: los objetos ORM pertenecen a la sesión de este hilo
+    cola_grupos = queue.Queue()
+    for grupo in grupos:
+        cola_grupos.put([user.id for user in grupo])
+    db.session.close()
+
+    # Cada hilo corre en una copia del contexto actual: hereda el Cron en curso (métricas)
+    hilos = [
+        threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(_worker_grupos, cola_grupos, procesar_grupo, resultados, fallidos),
+            daemon=True
+        )
+        for _ in range(concurrencia)
+    ]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    _avisar_grupos_fallidos(fallidos, len(grupos))
+    return resultados
+
+def _persistir_en_lotes(resultados, persistir, descripcion):
+    """
+    Escribe `resultados` [(user_id, datos)] llamando a `persistir(lote)` por lotes de
+    CRON_LOTE_ESCRITURA usuarios (un INSERT masivo y un commit por lote).
+    Si un lote falla se revierte y se reintenta usuario por usuario, para aislar al culpable.
+    """
+    tamano_lote = max(1, app.config['CRON_LOTE_ESCRITURA'])
+    for i in range(0, len(resultados), tamano_lote):
+        lote = resultados[i:i + tamano_lote]
+        try:
+            persistir(lote)
         except Exception as e:
             db.session.rollback()
-            app.logger.error(f"Error generando misión para {user.username}: {e}")
+            app.logger.error(f"Error {descripcion} por lote ({len(lote)} usuario(s)), se reintenta por usuario: {e}")
+            for resultado in lote:
+                try:
+                    persistir([resultado])
+                except Exception as e:
+                    db.session.rollback()
+                    app.logger.error(f"Error {descripcion} para user_id={resultado[0]}: {e}")
+                    _contar_cron('progreso_cron_fallos_total')
+
+def _respuesta_lote_por_usuario(prompt, usar_cache=False):
+    """
+    Envía un prompt multi-usuario y devuelve {user_id: respuesta_cruda}.
+    Si la respuesta completa es inválida devuelve {} y todos los usuarios caen al modo individual.
+    """
+    try:
+        response_json = _get_gemini_response(prompt, want_json=True, usar_cache=usar_cache)
+        data = json.loads(response_json)
+        if not isinstance(data, dict):
+            raise Exception("La respuesta del lote no es un objeto indexado por user_id")
+        return {int(user_id): valor for user_id, valor in data.items() if str(user_id).isdigit()}
+    except Exception as e:
+        app.logger.error(f"Error en prompt por lotes, se usará el modo individual: {e}")
+        return {}
+
+def _validar_misiones(data, cantidad):
+    """Normaliza y valida la respuesta de misiones de UN usuario. Lanza ValueError si no sirve."""
+    # Normalizar la respuesta de la IA (sea un objeto o una lista)
+    if isinstance(data, list):
+        misiones_data = data
+    elif isinstance(data, dict):
+        misiones_data = [data]
+    else:
+        raise ValueError("Respuesta de IA no tiene el formato esperado (ni lista ni objeto)")
+
+    misiones_data = [
+        m for m in misiones_data
+        if isinstance(m, dict) and isinstance(m.get('titulo'), str) and m['titulo'].strip()
+    ]
+    if not misiones_data:
+        raise ValueError("La respuesta de IA no contiene misiones válidas")
+    for mision_data in misiones_data:
+        mision_data['recompensa_pesos'] = int(mision_data.get('recompensa_pesos', 5000))
+    return misiones_data[:cantidad]
+
+def _plazo_misiones_hoy():
+    """Plazo (en UTC) de las misiones generadas hoy: la hora de verificación en la zona del usuario."""
+    now_user_tz = datetime.now(USER_TZ)
+    plazo_local = now_user_tz.replace(hour=HORA_VERIFICACION, minute=0, second=0, microsecond=0)
+    return plazo_local.astimezone(pytz.utc)
+
+def _persistir_misiones(resultados):
+    """
+    Inserta las misiones ya validadas de varios usuarios, `resultados` [(user_id, misiones_data)],
+    con UN INSERT masivo y un commit. Las áreas se resuelven con un mapa precargado de una consulta,
+    y las filas no pasan por el identity map del ORM.
+    """
+    user_ids = [user_id for user_id, _ in resultados]
+    # Orden descendente: ante nombres repetidos gana el área más antigua, como hacía el .first()
+    areas_por_nombre = {
+        (user_id, nombre): area_id
+        for area_id, user_id, nombre in db.session.execute(
+            db.select(AreaVida.id, AreaVida.user_id, AreaVida.nombre)
+            .where(AreaVida.user_id.in_(user_ids))
+            .order_by(AreaVida.id.desc())
+        )
+    }
+    plazo_utc = _plazo_misiones_hoy()
+
+    filas = [
+        {
+            'titulo': mision_data.get('titulo', 'Misión Diaria (Error IA)'),
+            'recompensa_xp': 50,
+            'recompensa_pesos': mision_data.get('recompensa_pesos', 5000),
+            'completada': False,
+            'plazo': plazo_utc,
+            'user_id': user_id,
+            'area_id': areas_por_nombre.get((user_id, mision_data.get('area_nombre')))
+        }
+        for user_id, misiones_data in resultados
+        for mision_data in misiones_data
+    ]
+    if filas:
+        db.session.execute(db.insert(Mision), filas)
+        _sumar_contadores_areas('misiones_activas', Counter(fila['area_id'] for fila in filas))
+    _incrementar_version_datos(user_ids)
+    db.session.commit() # Un commit por lote de usuarios
+
+def _pedir_misiones_usuario(user, usar_cache=False):
+    """
+    Pide a la IA las misiones del día de un usuario y las devuelve validadas (sin guardarlas).
+    Devuelve None si el usuario no tiene áreas de vida. Lanza excepción si algo falla.
+    """
+    app.logger.info(f"Generando {user.ai_misiones_por_dia} misión(es) para: {user.username}")
+    metas = f"Personales: {user.metas_personales}\nProfesionales: {user.metas_profesionales}"
+    areas = AreaVida.query.filter_by(autor=user).all()
+    if not areas:
+        app.logger.warning(f"Usuario {user.username} no tiene áreas de vida. Saltando.")
+        return None
+
+    nombres_areas = ", ".join([a.nombre for a in areas])
+    cantidad_misiones = user.ai_misiones_por_dia
+
+    prompt = textwrap.dedent(f"""
+    **Rol:** Eres "ProgreSO", un coach de IA.
+    **Perfil del Usuario:**
+    - Metas Principales: {metas}
+    - Áreas de Enfoque: {nombres_areas}
+    **Tarea:** Genera exactamente {cantidad_misiones} misión(es) diaria(s), pequeña(s) y accionable(s), que ayuden al usuario a avanzar en sus metas.
+    
+    **Formato de Salida:** Responde ÚNICAMENTE con un objeto JSON.
+    Si {cantidad_misiones} == 1, responde con un objeto:
+    {{"titulo": "...", "area_nombre": "...", "recompensa_pesos": 5000}}
+    
+    Si {cantidad_misiones} > 1, responde con una LISTA de objetos:
+    [
+      {{"titulo": "Misión 1", "area_nombre": "Área 1", "recompensa_pesos": 5000}},
+      {{"titulo": "Misión 2", "area_nombre": "Área 2", "recompensa_pesos": 3000}}
+    ]
+    
+    **Reglas:**
+    - "area_nombre" debe ser un nombre EXACTO de la lista de Áreas de Enfoque.
+    """)
+    
+    response_json = _get_gemini_response(prompt, want_json=True, usar_cache=usar_cache)
+    return _validar_misiones(json.loads(response_json), cantidad_misiones)
+
+def _generar_misiones_usuario(user, usar_cache=False):
+    """Genera y guarda las misiones del día de UN usuario (usado por la cola de tareas)."""
+    misiones_data = _pedir_misiones_usuario(user, usar_cache)
+    if misiones_data:
+        _persistir_misiones([(user.id, misiones_data)])
+
+def _generar_misiones_grupo(users, usar_cache=False):
+    """
+    Genera las misiones de un grupo de usuarios con UN solo prompt.
+    Cada respuesta se valida por separado; quien falte o sea inválido se procesa en modo individual.
+    No escribe en la BD: devuelve [(user_id, misiones_data)] para persistirlos por lotes.
+    """
+    pedir_individual = functools.partial(_pedir_misiones_usuario, usar_cache=usar_cache)
+    if len(users) == 1:
+        misiones_data = _procesar_usuario_aislado(users[0], pedir_individual, "generando misión")
+        return [(users[0].id, misiones_data)] if misiones_data else []
+
+    areas_por_usuario = {}
+    for area in AreaVida.query.filter(AreaVida.user_id.in_([u.id for u in users])).all():
+        areas_por_usuario.setdefault(area.user_id, []).append(area.nombre)
+
+    perfiles = []
+    for user in users:
+        if not areas_por_usuario.get(user.id):
+            app.logger.warning(f"Usuario {user.username} no tiene áreas de vida. Saltando.")
+            continue
+        perfiles.append({
+            "user_id": user.id,
+            "metas_personales": user.metas_personales,
+            "metas_profesionales": user.metas_profesionales,
+            "areas_de_enfoque": areas_por_usuario[user.id],
+            "cantidad_misiones": user.ai_misiones_por_dia
+        })
+    if not perfiles:
+        return []
+
+    app.logger.info(f"Generando misiones por lote para {len(perfiles)} usuario(s)")
+    prompt = textwrap.dedent("""
+    **Rol:** Eres "ProgreSO", un coach de IA.
+    **Tarea:** Para CADA usuario de la lista, genera exactamente "cantidad_misiones" misión(es) diaria(s),
+    pequeña(s) y accionable(s), que le ayuden a avanzar en sus metas.
+
+    **Usuarios (JSON):**
+    {perfiles}
+
+    **Formato de Salida:** Responde ÚNICAMENTE con un objeto JSON cuyas claves son el "user_id" (como texto)
+    y cuyos valores son LISTAS de misiones:
+    {{
+      "12": [{{"titulo": "Misión 1", "area_nombre": "Área 1", "recompensa_pesos": 5000}}],
+      "15": [{{"titulo": "Misión 1", "area_nombre": "Área 3", "recompensa_pesos": 3000}}]
+    }}
+
+    **Reglas:**
+    - Incluye TODOS los user_id de la lista.
+    - "area_nombre" debe ser un nombre EXACTO de las "areas_de_enfoque" de ESE usuario.
+    """).format(perfiles=json.dumps(perfiles, ensure_ascii=False, indent=2))
+
+    respuestas = _respuesta_lote_por_usuario(prompt, usar_cache)
+    users_por_id = {user.id: user for user in users}
+    resultados = []
+
+    for perfil in perfiles:
+        user = users_por_id[perfil["user_id"]]
+        try:
+            misiones_data = _validar_misiones(respuestas[user.id], perfil["cantidad_misiones"])
+        except (KeyError, ValueError, TypeError) as e:
+            app.logger.warning(f"Respuesta por lote inválida para {user.username} ({e!r}). Reintentando individualmente.")
+            misiones_data = _procesar_usuario_aislado(user, pedir_individual, "generando misión")
+        if misiones_data:
+            resultados.append((user.id, misiones_data))
+    return resultados
+
+@_medir_cron('generar_misiones')
+def _generar_misiones_diarias_logic(concurrencia=None, lote=None, usar_cache=None, shard=None, num_shards=None):
+    """
+    Lógica para el Cron Job 1.
+    Genera nuevas misiones diarias para cada usuario.
+    `concurrencia` limita cuántos grupos se atienden en paralelo (por defecto CRON_CONCURRENCIA),
+    `lote` cuántos usuarios comparten un mismo prompt (por defecto CRON_LOTE_USUARIOS)
+    y `usar_cache` si se reutilizan respuestas de la IA (por defecto IA_CACHE_CRON).
+    Con `shard`/`num_shards` sólo procesa los usuarios con id % num_shards == shard.
+    Las misiones de cada bloque se escriben con INSERT masivos (ver _persistir_en_lotes).
+    """
+    if usar_cache is None:
+        usar_cache = app.config['IA_CACHE_CRON']
+    app.logger.info("Iniciando lógica de Cron: Generar Misiones Diarias...")
+    
+    procesar_grupo = functools.partial(_generar_misiones_grupo, usar_cache=usar_cache)
+    bloques = _iterar_bloques_usuarios(User.metas_personales != None, shard=shard, num_shards=num_shards)
+    for users in bloques:
+        resultados = _ejecutar_en_grupos(users, procesar_grupo, concurrencia, lote or app.config['CRON_LOTE_USUARIOS'])
+        _persistir_en_lotes(resultados, _persistir_misiones, "guardando misiones")
     
     return "Generación de misiones completada."
 
-def _verificar_misiones_fallidas_logic():
+PENALIZACION_MISION_FALLIDA = 10 # HP que se pierden por cada misión diaria no completada
+
+def _notificar_mision_fallida(user, titulos_misiones, personalidad_prompt, usar_cache=False):
+    """Genera y guarda el mensaje del asistente para un usuario que falló misiones."""
+    prompt_asistente = textwrap.dedent(f"""
+    **Rol:** {personalidad_prompt}
+    **Tarea:** Escribe un breve mensaje (max 40 palabras) para tu usuario, {user.username}.
+    **Contexto:** El usuario NO completó {len(titulos_misiones)} misión(es) diaria(s) antes de las 18:00: '{', '.join(titulos_misiones)}'.
+    Ha perdido {PENALIZACION_MISION_FALLIDA * len(titulos_misiones)} HP.
+    Escribe el mensaje con tu personalidad, lamentando que falló pero animándolo (o no) para mañana.
+    """)
+    
+    mensaje_bot = _get_gemini_response(prompt_asistente, usar_cache=usar_cache)
+    
+    nuevo_mensaje = MensajeAsistente(
+        user_id=user.id,
+        contenido=mensaje_bot
+    )
+    db.session.add(nuevo_mensaje)
+    db.session.commit() # Un commit por mensaje: no se retiene la escritura durante Gemini
+
+@_medir_cron('verificar_misiones')
+def _verificar_misiones_fallidas_logic(usar_cache=None, shard=None, num_shards=None):
     """
     Lógica para el Cron Job 2.
     Verifica las misiones diarias que no se completaron y aplica penalización.
+    Las misiones vencidas se reclaman primero con un solo UPDATE ... RETURNING (completada=True
+    condicional), igual que completar_mision: una misión completada entretanto no se penaliza ni
+    se descuenta dos veces de su área, y ambos bloquean misión y luego área. Las penalizaciones
+    del libro y los contadores salen sólo de las filas reclamadas. Sólo las notificaciones se
+    hacen por usuario.
     """
+    if usar_cache is None:
+        usar_cache = app.config['IA_CACHE_CRON']
     app.logger.info("Iniciando lógica de Cron: Verificar Misiones Fallidas...")
-    
-    misiones_fallidas = Mision.query.filter(
+
+    ahora = datetime.utcnow()
+    vencidas = (
         Mision.completada == False,
-        Mision.plazo < datetime.utcnow()
-    ).all()
-    
-    users_notificados = {} 
+        Mision.plazo < ahora,
+        *_filtro_shard(Mision.user_id, shard, num_shards)
+    )
+    sin_sincronizar = {'synchronize_session': False}
+    columnas = (Mision.id, Mision.user_id, Mision.area_id, Mision.titulo)
+
+    # 1. Reclamar las misiones vencidas marcándolas como completadas (fallidas)
+    if db.engine.dialect.update_returning:
+        filas = db.session.execute(
+            db.update(Mision).where(*vencidas).values(completada=True).returning(*columnas),
+            execution_options=sin_sincronizar
+        ).all()
+    else:
+        # Sin RETURNING (MySQL): se bloquean las filas al leerlas y se marcan por id
+        filas = db.session.execute(db.select(*columnas).where(*vencidas).with_for_update()).all()
+        if filas:
+            db.session.execute(
+                db.update(Mision).where(Mision.id.in_([fila.id for fila in filas])).values(completada=True),
+                execution_options=sin_sincronizar
+            )
 
-    for mision in misiones_fallidas:
-        user = mision.autor
-        app.logger.info(f"Procesando misión fallida '{mision.titulo}' para {user.username}")
-        
-        penalizacion_hp = 10
-        user.vida = max(user.vida - penalizacion_hp, 0)
-        mision.completada = True # Marcamos como completada (fallida)
-        
-        users_notificados.setdefault(user.id, []).append(mision.titulo)
+    # 2. Contadores de las áreas, en orden de id (mismo orden de bloqueo entre ejecuciones)
+    vencidas_por_area = Counter(fila.area_id for fila in filas)
+    _sumar_contadores_areas('misiones_activas', {
+        area_id: -vencidas_por_area[area_id] for area_id in sorted(filter(None, vencidas_por_area))
+    })
+
+    # 3. Penalización de HP: un movimiento por usuario en el libro, con un INSERT executemany
+    vencidas_por_usuario = Counter(fila.user_id for fila in filas)
+    if vencidas_por_usuario:
+        db.session.execute(db.insert(MovimientoEconomia.__table__), [
+            {
+                'user_id': user_id, 'tipo': 'penalizacion', 'origen': 'cron:misiones_vencidas',
+                'xp': 0, 'pesos': 0, 'vida': -PENALIZACION_MISION_FALLIDA * n, 'timestamp': ahora
+            }
+            for user_id, n in sorted(vencidas_por_usuario.items())
+        ])
+
+    # Las penalizaciones se confirman antes de llamar a la IA: no se retiene la escritura durante Gemini
+    db.session.commit()
+
+    users_notificados = {}
+    for fila in filas:
+        users_notificados.setdefault(fila.user_id, []).append(fila.titulo)
+    app.logger.info(f"{len(filas)} misión(es) fallida(s) de {len(users_notificados)} usuario(s) penalizadas.")
+    _contar_cron('progreso_cron_usuarios_total', len(users_notificados))
+
+    # 4. Notificaciones (lo único que necesita trabajo por usuario)
+    personalidades = {p.nombre: p.prompt_descripcion for p in AsistentePersonalidad.query.all()}
+    user_ids = sorted(users_notificados)
+    tamano_bloque = app.config['CRON_TAMANO_BLOQUE']
+    for i in range(0, len(user_ids), tamano_bloque):
+        for user in User.query.filter(User.id.in_(user_ids[i:i + tamano_bloque])).order_by(User.id):
+            personalidad_prompt = personalidades.get(user.asistente_persona, "Eres un asistente amigable.")
+            _procesar_usuario_aislado(
+                user,
+                lambda u: _notificar_mision_fallida(u, users_notificados[u.id], personalidad_prompt, usar_cache),
+                "generando mensaje de bot"
+            )
     
-    for user_id, titulos_misiones in users_notificados.items():
-        try:
-            user = User.query.get(user_id)
-            personalidad = AsistentePersonalidad.query.filter_by(nombre=user.asistente_persona).first()
-            
-            prompt_asistente = textwrap.dedent(f"""
-            **Rol:** {personalidad.prompt_descripcion}
-            **Tarea:** Escribe un breve mensaje (max 40 palabras) para tu usuario, {user.username}.
-            **Contexto:** El usuario NO completó {len(titulos_misiones)} misión(es) diaria(s) antes de las 18:00: '{', '.join(titulos_misiones)}'.
-            Ha perdido {10 * len(titulos_misiones)} HP.
-            Escribe el mensaje con tu personalidad, lamentando que falló pero animándolo (o no) para mañana.
-            """)
-            
-            mensaje_bot = _get_gemini_response(prompt_asistente)
-            
-            if "Error" not in mensaje_bot:
-                nuevo_mensaje = MensajeAsistente(
-                    user_id=user.id,
-                    contenido=mensaje_bot
-                )
-                db.session.add(nuevo_mensaje)
-        
-        except Exception as e:
-            app.logger.error(f"Error generando mensaje de bot para user {user_id}: {e}")
+    return "Verificación de misiones completada."
+
+def _ventana_dia_utc():
+    """Inicio y fin (en UTC) del día de hoy en la zona horaria del usuario."""
+    today_user_tz = datetime.now(USER_TZ).date()
+    start_of_day_user = datetime.combine(today_user_tz, time.min, tzinfo=USER_TZ)
+    end_of_day_user = datetime.combine(today_user_tz, time.max, tzinfo=USER_TZ)
+    return start_of_day_user.astimezone(pytz.utc), end_of_day_user.astimezone(pytz.utc)
+
+def _resumen_misiones_dia(user_ids, start_of_day_utc, end_of_day_utc):
+    """
+    Misiones completadas y fallidas del día para varios usuarios en UNA consulta agrupada.
+    Devuelve {user_id: (completadas, fallidas)}; quien no tuvo misiones no aparece.
+    """
+    filas = db.session.execute(
+        db.select(
+            Mision.user_id,
+            db.func.count(Mision.id),
+            db.func.sum(db.case((Mision.completada == True, 1), else_=0))
+        )
+        .where(Mision.user_id.in_(user_ids), Mision.plazo.between(start_of_day_utc, end_of_day_utc))
+        .group_by(Mision.user_id)
+    ).all()
+    return {user_id: (completadas or 0, total - (completadas or 0)) for user_id, total, completadas in filas}
+
+def _prompt_reporte(user, misiones_completadas_hoy, misiones_fallidas_hoy, personalidad_prompt):
+    return textwrap.dedent(f"""
+    **Rol:** {personalidad_prompt}
+    **Tarea:** Escribe un breve reporte de fin de día (máximo 70 palabras) para tu usuario, {user.username}.
+    **Resumen del Día:**
+    - Salud (HP) actual: {user.vida}%
+    - Misiones Diarias Completadas: {misiones_completadas_hoy}
+    - Misiones Diarias Fallidas: {misiones_fallidas_hoy}
+    - (No menciones los hábitos, la data no es fiable)
+    Escribe el reporte en primera persona (como "yo", el asistente). Sé breve, motivador (o sarcástico, etc., según tu rol) y menciona 1 o 2 puntos clave del resumen.
+    """)
+
+def _guardar_reporte(user, prompt, usar_cache=False):
+    """Llama a la IA con el prompt del reporte y guarda el mensaje (un commit por usuario)."""
+    reporte_contenido = _get_gemini_response(prompt, usar_cache=usar_cache)
     
+    nuevo_mensaje = MensajeAsistente(
+        user_id=user.id,
+        contenido=reporte_contenido
+    )
+    db.session.add(nuevo_mensaje)
     db.session.commit()
-    return "Verificación de misiones completada."
 
-def _generar_reporte_diario_logic():
+def _generar_reporte_usuario(user, usar_cache=False):
+    """Genera y guarda el reporte de fin de día de UN usuario (usado por la cola de tareas)."""
+    app.logger.info(f"Generando reporte para: {user.username}")
+    completadas, fallidas = _resumen_misiones_dia([user.id], *_ventana_dia_utc()).get(user.id, (0, 0))
+    _aplicar_cola_economia(user)
+
+    personalidad = AsistentePersonalidad.query.filter_by(nombre=user.asistente_persona).first()
+    if not personalidad:
+        personalidad_prompt = "Eres un asistente amigable."
+    else:
+        personalidad_prompt = personalidad.prompt_descripcion
+
+    _guardar_reporte(user, _prompt_reporte(user, completadas, fallidas, personalidad_prompt), usar_cache)
+
+@_medir_cron('generar_reporte')
+def _generar_reporte_diario_logic(usar_cache=None, shard=None, num_shards=None):
     """
     Lógica para el Cron Job 3.
     Genera un reporte diario para CADA usuario.
+    Los conteos del día salen de una consulta agrupada por bloque de usuarios y las
+    personalidades de un mapa en memoria: el bucle por usuario sólo arma prompts.
     """
+    if usar_cache is None:
+        usar_cache = app.config['IA_CACHE_CRON']
     app.logger.info("Iniciando lógica de Cron: Generar Reportes Diarios...")
-    users = User.query.all()
-    
-    for user in users:
-        app.logger.info(f"Generando reporte para: {user.username}")
-        try:
-            today_user_tz = datetime.now(USER_TZ).date()
-            start_of_day_user = datetime.combine(today_user_tz, time.min, tzinfo=USER_TZ)
-            end_of_day_user = datetime.combine(today_user_tz, time.max, tzinfo=USER_TZ)
-            start_of_day_utc = start_of_day_user.astimezone(pytz.utc)
-            end_of_day_utc = end_of_day_user.astimezone(pytz.utc)
-
-            misiones_hoy = Mision.query.filter(
-                Mision.autor == user,
-                Mision.plazo.between(start_of_day_utc, end_of_day_utc)
-            )
-            misiones_completadas_hoy = misiones_hoy.filter_by(completada=True).count()
-            misiones_fallidas_hoy = misiones_hoy.count() - misiones_completadas_hoy
 
-            personalidad = AsistentePersonalidad.query.filter_by(nombre=user.asistente_persona).first()
-            if not personalidad:
-                personalidad_prompt = "Eres un asistente amigable."
-            else:
-                personalidad_prompt = personalidad.prompt_descripcion
-
-            prompt = textwrap.dedent(f"""
-            **Rol:** {personalidad_prompt}
-            **Tarea:** Escribe un breve reporte de fin de día (máximo 70 palabras) para tu usuario, {user.username}.
-            **Resumen del Día:**
-            - Salud (HP) actual: {user.vida}%
-            - Misiones Diarias Completadas: {misiones_completadas_hoy}
-            - Misiones Diarias Fallidas: {misiones_fallidas_hoy}
-            - (No menciones los hábitos, la data no es fiable)
-            Escribe el reporte en primera persona (como "yo", el asistente). Sé breve, motivador (o sarcástico, etc., según tu rol) y menciona 1 o 2 puntos clave del resumen.
-            """)
-            
-            reporte_contenido = _get_gemini_response(prompt)
-            
-            if "Error" not in reporte_contenido:
-                nuevo_mensaje = MensajeAsistente(
-                    user_id=user.id,
-                    contenido=reporte_contenido
-                )
-                db.session.add(nuevo_mensaje)
-                db.session.commit()
-            
-        except Exception as e:
-            db.session.rollback()
-            app.logger.error(f"Error generando reporte para {user.username}: {e}")
+    start_of_day_utc, end_of_day_utc = _ventana_dia_utc()
+    personalidades = {p.nombre: p.prompt_descripcion for p in AsistentePersonalidad.query.all()}
+    _compactar_economia(shard=shard, num_shards=num_shards) # Menos cola que plegar en cada bloque
+    
+    for users in _iterar_bloques_usuarios(shard=shard, num_shards=num_shards):
+        resumen = _resumen_misiones_dia([u.id for u in users], start_of_day_utc, end_of_day_utc)
+        # La compactación deja en el libro los movimientos recientes: el HP vigente es foto + cola.
+        # Los prompts del bloque se arman antes del primer commit (que expira las fotos)
+        _aplicar_colas_economia(users)
+        prompts = {}
+        for user in users:
+            completadas, fallidas = resumen.get(user.id, (0, 0))
+            personalidad_prompt = personalidades.get(user.asistente_persona, "Eres un asistente amigable.")
+            prompts[user.id] = (user.username, _prompt_reporte(user, completadas, fallidas, personalidad_prompt))
+        for user in users:
+            username, prompt = prompts[user.id]
+            app.logger.info(f"Generando reporte para: {username}")
+            _procesar_usuario_aislado(user, lambda u: _guardar_reporte(u, prompt, usar_cache), "generando reporte")
 
     return "Generación de reportes completada."
 
 # --- NUEVA LÓGICA DE CRON PARA TIENDA ---
-def _actualizar_tienda_diaria_logic():
+def _validar_items_tienda(data, cantidad):
+    """Valida la respuesta de tienda de UN usuario. Lanza ValueError si no sirve."""
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list):
+        raise ValueError("Respuesta de IA no tiene el formato esperado (lista de items)")
+    items = [
+        item for item in data
+        if isinstance(item, dict) and isinstance(item.get('nombre'), str) and item['nombre'].strip()
+    ]
+    if not items:
+        raise ValueError("La respuesta de IA no contiene items válidos")
+    for item in items:
+        item['costo_pesos'] = int(item.get('costo_pesos', 10000))
+    return items[:cantidad]
+
+def _persistir_tiendas(resultados):
+    """
+    Reemplaza la tienda de varios usuarios, `resultados` [(user_id, items)], con UN DELETE
+    y UN INSERT masivo en un solo commit, sin pasar las filas por el identity map del ORM.
+    """
+    # 1. Borrar items antiguos de las tiendas del lote
+    db.session.execute(
+        db.delete(TiendaItem).where(TiendaItem.user_id.in_([user_id for user_id, _ in resultados])),
+        execution_options={'synchronize_session': False}
+    )
+
+    # 2. Añadir items nuevos a la BD
+    filas = [
+        {'nombre': item.get('nombre'), 'costo_pesos': item.get('costo_pesos', 10000), 'user_id': user_id}
+        for user_id, items in resultados
+        for item in items
+    ]
+    if filas:
+        db.session.execute(db.insert(TiendaItem), filas)
+    _incrementar_version_datos(user_id for user_id, _ in resultados)
+    
+    db.session.commit()
+
+def _pedir_tienda_usuario(user, usar_cache=False):
+    """Pide a la IA la tienda del día de un usuario y la devuelve validada (sin guardarla)."""
+    app.logger.info(f"Actualizando tienda para: {user.username}")
+    cantidad_items = user.ai_tienda_items_por_dia
+    prompt = textwrap.dedent(f"""
+    **Rol:** Eres "ProgreSO", un coach de IA.
+    **Perfil del Usuario:**
+    - Hobbies: {user.hobbies}
+    **Tarea:** Genera exactamente {cantidad_items} recompensas de tienda personalizadas.
+    
+    **Formato de Salida:** Responde ÚNICAMENTE con una LISTA de objetos JSON.
+    [
+      {{"nombre": "Recompensa 1", "costo_pesos": 20000}},
+      {{"nombre": "Recompensa 2", "costo_pesos": 70000}}
+    ]
+    """)
+    
+    response_json = _get_gemini_response(prompt, want_json=True, usar_cache=usar_cache)
+    return _validar_items_tienda(json.loads(response_json), cantidad_items)
+
+def _actualizar_tienda_usuario(user, usar_cache=False):
+    """Genera y guarda la tienda del día de UN usuario (usado por la cola de tareas)."""
+    _persistir_tiendas([(user.id, _pedir_tienda_usuario(user, usar_cache))])
+
+def _actualizar_tienda_grupo(users, usar_cache=False):
+    """
+    Genera la tienda de un grupo de usuarios con UN solo prompt.
+    Cada respuesta se valida por separado; quien falte o sea inválido se procesa en modo individual.
+    No escribe en la BD: devuelve [(user_id, items)] para persistirlos por lotes.
+    """
+    pedir_individual = functools.partial(_pedir_tienda_usuario, usar_cache=usar_cache)
+    if len(users) == 1:
+        items = _procesar_usuario_aislado(users[0], pedir_individual, "actualizando tienda")
+        return [(users[0].id, items)] if items else []
+
+    perfiles = [
+        {"user_id": user.id, "hobbies": user.hobbies, "cantidad_items": user.ai_tienda_items_por_dia}
+        for user in users
+    ]
+    app.logger.info(f"Actualizando tiendas por lote para {len(perfiles)} usuario(s)")
+    prompt = textwrap.dedent("""
+    **Rol:** Eres "ProgreSO", un coach de IA.
+    **Tarea:** Para CADA usuario de la lista, genera exactamente "cantidad_items" recompensas de tienda
+    personalizadas según sus hobbies.
+
+    **Usuarios (JSON):**
+    {perfiles}
+
+    **Formato de Salida:** Responde ÚNICAMENTE con un objeto JSON cuyas claves son el "user_id" (como texto)
+    y cuyos valores son LISTAS de recompensas:
+    {{
+      "12": [{{"nombre": "Recompensa 1", "costo_pesos": 20000}}],
+      "15": [{{"nombre": "Recompensa 1", "costo_pesos": 70000}}]
+    }}
+
+    **Reglas:**
+    - Incluye TODOS los user_id de la lista.
+    """).format(perfiles=json.dumps(perfiles, ensure_ascii=False, indent=2))
+
+    respuestas = _respuesta_lote_por_usuario(prompt, usar_cache)
+    resultados = []
+
+    for user in users:
+        try:
+            items = _validar_items_tienda(respuestas[user.id], user.ai_tienda_items_por_dia)
+        except (KeyError, ValueError, TypeError) as e:
+            app.logger.warning(f"Respuesta por lote inválida para {user.username} ({e!r}). Reintentando individualmente.")
+            items = _procesar_usuario_aislado(user, pedir_individual, "actualizando tienda")
+        if items:
+            resultados.append((user.id, items))
+    return resultados
+
+@_medir_cron('actualizar_tienda')
+def _actualizar_tienda_diaria_logic(concurrencia=None, lote=None, usar_cache=None, shard=None, num_shards=None):
     """
     Lógica para el Cron Job 4.
     Refresca la tienda para cada usuario.
+    Cada lote de usuarios se reemplaza con un DELETE y un INSERT masivo (ver _persistir_en_lotes).
     """
+    if usar_cache is None:
+        usar_cache = app.config['IA_CACHE_CRON']
     app.logger.info("Iniciando lógica de Cron: Actualizar Tienda Diaria...")
-    users = User.query.filter(User.metas_personales != None).all()
     
-    for user in users:
-        app.logger.info(f"Actualizando tienda para: {user.username}")
-        try:
-            # 1. Borrar items antiguos de la tienda
-            TiendaItem.query.filter_by(autor=user).delete()
-            
-            # 2. Generar items nuevos
-            cantidad_items = user.ai_tienda_items_por_dia
-            prompt = textwrap.dedent(f"""
-            **Rol:** Eres "ProgreSO", un coach de IA.
-            **Perfil del Usuario:**
-            - Hobbies: {user.hobbies}
-            **Tarea:** Genera exactamente {cantidad_items} recompensas de tienda personalizadas.
-            
-            **Formato de Salida:** Responde ÚNICAMENTE con una LISTA de objetos JSON.
-            [
-              {{"nombre": "Recompensa 1", "costo_pesos": 20000}},
-              {{"nombre": "Recompensa 2", "costo_pesos": 70000}}
-            ]
-            """)
-            
-            response_json = _get_gemini_response(prompt, want_json=True)
-            if "Error" in response_json:
-                raise Exception(response_json)
-                
-            data = json.loads(response_json)
-            
-            # 3. Añadir items nuevos a la BD
-            for item in data:
-                nuevo_item = TiendaItem(
-                    nombre=item.get('nombre'),
-                    costo_pesos=item.get('costo_pesos', 10000),
-                    autor=user
-                )
-                db.session.add(nuevo_item)
-            
-            db.session.commit()
-
-        except Exception as e:
-            db.session.rollback()
-            app.logger.error(f"Error actualizando tienda para {user.username}: {e}")
+    procesar_grupo = functools.partial(_actualizar_tienda_grupo, usar_cache=usar_cache)
+    bloques = _iterar_bloques_usuarios(User.metas_personales != None, shard=shard, num_shards=num_shards)
+    for users in bloques:
+        resultados = _ejecutar_en_grupos(users, procesar_grupo, concurrencia, lote or app.config['CRON_LOTE_USUARIOS'])
+        _persistir_en_lotes(resultados, _persistir_tiendas, "actualizando tienda")
     
     return "Actualización de tiendas completada."
 
 
+# --- Cola de Tareas de Cron (BD) ---
+
+def _tarea_generar_misiones(user, payload):
+    _generar_misiones_usuario(user, usar_cache=payload.get('usar_cache', False))
+
+def _tarea_actualizar_tienda(user, payload):
+    _actualizar_tienda_usuario(user, usar_cache=payload.get('usar_cache', False))
+
+def _tarea_generar_reporte(user, payload):
+    _generar_reporte_usuario(user, usar_cache=payload.get('usar_cache', False))
+
+def _tarea_verificar_misiones(user, payload):
+    # La verificación opera sobre todas las misiones vencidas a la vez: es una sola tarea global (por shard)
+    _verificar_misiones_fallidas_logic(
+        usar_cache=payload.get('usar_cache', False),
+        shard=payload.get('shard'),
+        num_shards=payload.get('num_shards')
+    )
+
+# tipo -> (función(user, payload), requiere usuario)
+TAREAS_CRON = {
+    'generar_misiones': (_tarea_generar_misiones, True),
+    'actualizar_tienda': (_tarea_actualizar_tienda, True),
+    'generar_reporte': (_tarea_generar_reporte, True),
+    'verificar_misiones': (_tarea_verificar_misiones, False),
+    'setup_ia': (_generar_setup_usuario, True),
+}
+
+def _encolar_tareas(tipo, user_ids, payload=None):
+    """
+    Encola una tarea `tipo` por cada usuario (o una global si `user_ids` es None).
+    No duplica tareas del mismo tipo que sigan pendientes o en proceso: las por usuario se
+    distinguen por user_id y las globales por su shard. Devuelve cuántas encoló.
+    """
+    def clave_global(datos):
+        return (None, datos.get('shard'), datos.get('num_shards'))
+
+    activas = set()
+    for user_id, payload_activa in db.session.execute(
+        db.select(TareaCron.user_id, db.case((TareaCron.user_id == None, TareaCron.payload))).where(
+            TareaCron.tipo == tipo,
+            TareaCron.estado.in_(('pendiente', 'en_proceso'))
+        )
+    ):
+        activas.add(user_id if user_id is not None else clave_global(json.loads(payload_activa or '{}')))
+
+    ahora = datetime.utcnow()
+    objetivos = [clave_global(payload or {})] if user_ids is None else user_ids
+    filas = [
+        {
+            'tipo': tipo,
+            'user_id': None if user_ids is None else objetivo,
+            'payload': json.dumps(payload or {}),
+            'estado': 'pendiente',
+            'intentos': 0,
+            'max_intentos': app.config['CRON_TAREA_MAX_INTENTOS'],
+            'visible_desde': ahora,
+            'creado': ahora,
+            'actualizado': ahora,
+        }
+        for objetivo in objetivos if objetivo not in activas
+    ]
+    if filas:
+        db.session.execute(db.insert(TareaCron), filas)
+    db.session.commit()
+    return len(filas)
+
+def _condiciones_tarea_reclamable(ahora):
+    return (
+        TareaCron.estado.in_(('pendiente', 'en_proceso')), # 'en_proceso' vencida = worker caído
+        TareaCron.visible_desde <= ahora,
+        TareaCron.intentos < TareaCron.max_intentos,
+    )
+
+def _reclamar_tareas(limite):
+    """
+    Reclama hasta `limite` tareas listas y las oculta durante CRON_TAREA_VISIBILIDAD_SEGUNDOS.
+    En Postgres usa SELECT ... FOR UPDATE SKIP LOCKED; en SQLite, un UPDATE condicional por
+    tarea que sólo gana un worker. Devuelve [(id, intento)] de las reclamadas: el intento
+    identifica el reclamo (ver _ejecutar_tarea).
+    """
+    ahora = datetime.utcnow()
+    oculta_hasta = ahora + timedelta(seconds=app.config['CRON_TAREA_VISIBILIDAD_SEGUNDOS'])
+    condiciones = _condiciones_tarea_reclamable(ahora)
+    reclamar = dict(
+        estado='en_proceso',
+        intentos=TareaCron.intentos + 1,
+        visible_desde=oculta_hasta,
+        actualizado=ahora
+    )
+
+    # Tareas abandonadas por un worker caído que ya no tienen reintentos
+    db.session.execute(
+        db.update(TareaCron)
+        .where(
+            TareaCron.estado == 'en_proceso',
+            TareaCron.visible_desde <= ahora,
+            TareaCron.intentos >= TareaCron.max_intentos
+        )
+        .values(estado='fallida', actualizado=ahora)
+    )
+
+    if db.engine.dialect.name == 'postgresql':
+        filas = db.session.execute(
+            db.select(TareaCron.id, TareaCron.intentos).where(*condiciones)
+            .order_by(TareaCron.id).limit(limite)
+            .with_for_update(skip_locked=True)
+        ).all()
+        if filas:
+            db.session.execute(db.update(TareaCron).where(TareaCron.id.in_([f.id for f in filas])).values(**reclamar))
+        reclamadas = [(fila.id, fila.intentos + 1) for fila in filas]
+    else:
+        candidatos = db.session.execute(
+            db.select(TareaCron.id, TareaCron.intentos).where(*condiciones).order_by(TareaCron.id).limit(limite)
+        ).all()
+        reclamadas = []
+        for tarea_id, intentos in candidatos:
+            resultado = db.session.execute(
+                db.update(TareaCron)
+                .where(TareaCron.id == tarea_id, TareaCron.intentos == intentos, *condiciones)
+                .values(**reclamar)
+            )
+            if resultado.rowcount == 1:
+                reclamadas.append((tarea_id, intentos + 1))
+
+    db.session.commit()
+    return reclamadas
+
+def _renovar_visibilidad_tarea(tarea_id, intentos):
+    """UPDATE que vuelve a ocultar la tarea, sólo si sigue en proceso con nuestro intento (el reclamo es nuestro)."""
+    tabla = TareaCron.__table__
+    ahora = datetime.utcnow()
+    return (
+        db.update(tabla)
+        .where(tabla.c.id == tarea_id, tabla.c.estado == 'en_proceso', tabla.c.intentos == intentos)
+        .values(visible_desde=ahora + timedelta(seconds=app.config['CRON_TAREA_VISIBILIDAD_SEGUNDOS']), actualizado=ahora)
+    )
+
+def _latido_tarea(tarea_id, intentos, detener):
+    """
+    Hilo que, mientras la tarea corre, renueva su visibilidad cada tercio de
+    CRON_TAREA_VISIBILIDAD_SEGUNDOS: una tarea larga (p. ej. verificar_misiones global) no
+    reaparece en la cola mientras su worker siga vivo. Sólo toca la fila si sigue siendo
+    nuestro intento, con su propia conexión (la sesión pertenece al hilo de la tarea).
+    """
+    with app.app_context():
+        while not detener.wait(app.config['CRON_TAREA_VISIBILIDAD_SEGUNDOS'] / 3):
+            try:
+                with db.engine.begin() as conexion:
+                    conexion.execute(_renovar_visibilidad_tarea(tarea_id, intentos))
+            except Exception as e:
+                app.logger.warning(f"No se pudo renovar la visibilidad de la tarea {tarea_id}: {e}")
+
+def _ejecutar_tarea(tarea_id, intentos):
+    """
+    Ejecuta la tarea reclamada con el intento `intentos` y registra su resultado (completada,
+    reintento o fallida). Antes de empezar confirma que el reclamo sigue siendo nuestro: si la
+    tarea venció y otro worker la volvió a reclamar, no se ejecuta (devuelve False).
+    """
+    tarea = db.session.get(TareaCron, tarea_id)
+    tipo, user_id, max_intentos = tarea.tipo, tarea.user_id, tarea.max_intentos
+    if db.session.execute(_renovar_visibilidad_tarea(tarea_id, intentos)).rowcount != 1:
+        db.session.rollback()
+        app.logger.warning(f"Tarea {tarea_id} ({tipo}) ya no es de este worker (intento {intentos}). Se omite.")
+        return False
+    db.session.commit()
+    token = _cron_en_curso.set(tipo)
+    detener_latido = threading.Event()
+    latido = threading.Thread(target=_latido_tarea, args=(tarea_id, intentos, detener_latido), daemon=True)
+    latido.start()
+    try:
+        funcion, requiere_usuario = TAREAS_CRON[tipo]
+        payload = json.loads(tarea.payload or '{}')
+        user = db.session.get(User, user_id) if user_id is not None else None
+        if requiere_usuario and user is None:
+            app.logger.warning(f"Tarea {tarea_id} ({tipo}) sin usuario válido. Se descarta.")
+        else:
+            funcion(user, payload)
+            _contar_cron('progreso_cron_usuarios_total', 1 if user is not None else 0)
+        valores = dict(estado='completada', ultimo_error=None)
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Error en tarea {tarea_id} ({tipo}, intento {intentos}/{max_intentos}): {e}")
+        _contar_cron('progreso_cron_fallos_total')
+        valores = dict(ultimo_error=str(e)[:2000])
+        if intentos < max_intentos:
+            # Reintento con backoff exponencial: 1, 2, 4... minutos
+            espera = 60 * (2 ** (intentos - 1))
+            valores.update(estado='pendiente', visible_desde=datetime.utcnow() + timedelta(seconds=espera))
+        else:
+            valores.update(estado='fallida')
+    finally:
+        detener_latido.set()
+        latido.join()
+        _cron_en_curso.reset(token)
+
+    valores['actualizado'] = datetime.utcnow()
+    db.session.execute(
+        db.update(TareaCron)
+        .where(TareaCron.id == tarea_id, TareaCron.intentos == intentos) # Si otro worker la reclamó, gana él
+        .values(**valores)
+    )
+    db.session.commit()
+    return valores['estado'] == 'completada'
+
+def _purgar_tareas_terminadas():
+    """Borra las tareas completadas o fallidas con más de CRON_TAREA_RETENCION_HORAS. Devuelve cuántas."""
+    limite = datetime.utcnow() - timedelta(hours=app.config['CRON_TAREA_RETENCION_HORAS'])
+    resultado = db.session.execute(
+        db.delete(TareaCron).where(TareaCron.estado.in_(('completada', 'fallida')), TareaCron.actualizado < limite)
+    )
+    db.session.commit()
+    return resultado.rowcount
+
+def _procesar_cola(limite=10):
+    """
+    Reclama y ejecuta hasta `limite` tareas, de una en una: cada tarea empieza en cuanto se
+    reclama, así que su visibilidad (que renueva el latido) no vence mientras espera turno.
+    Devuelve cuántas se procesaron.
+    """
+    procesadas = 0
+    for _ in range(limite):
+        reclamadas = _reclamar_tareas(1)
+        if not reclamadas:
+            break
+        _ejecutar_tarea(*reclamadas[0])
+        procesadas += 1
+    return procesadas
+
+def _usar_cola_cron():
+    """Lee `?cola=0|1` de la petición; sin parámetro se usa CRON_USAR_COLA."""
+    valor = request.args.get('cola')
+    if valor is None:
+        return app.config['CRON_USAR_COLA']
+    return valor.lower() not in ('0', 'false', 'no')
+
+def _encolar_cron(tipo, users_query):
+    """Encola una tarea por usuario de `users_query` (o una global si es None) y arma la respuesta."""
+    usar_cache = _parametro_cache_cron()
+    shard, num_shards = _parametros_shard()
+    payload = {'usar_cache': app.config['IA_CACHE_CRON'] if usar_cache is None else usar_cache}
+    user_ids = None
+    if users_query is not None:
+        user_ids = db.session.execute(
+            users_query.with_only_columns(User.id)
+            .where(*_filtro_shard(User.id, shard, num_shards))
+            .order_by(User.id)
+        ).scalars().all()
+    else:
+        payload.update(shard=shard, num_shards=num_shards)
+    encoladas = _encolar_tareas(tipo, user_ids, payload)
+    return jsonify(status="ok", message=f"{encoladas} tarea(s) '{tipo}' encolada(s).", encoladas=encoladas)
+
+
 # === Rutas de Cron Job (Gratuito) ===
 
+def _parametros_shard():
+    """Lee `?shard=K&num_shards=N` de la petición. Sin ellos se procesa toda la población."""
+    num_shards = request.args.get('num_shards', type=int)
+    shard = request.args.get('shard', default=0, type=int)
+    if num_shards is None or num_shards <= 1:
+        return None, None
+    if not 0 <= shard < num_shards:
+        abort(400, description="'shard' debe estar entre 0 y num_shards - 1.")
+    return shard, num_shards
+
+def _kwargs_shard():
+    shard, num_shards = _parametros_shard()
+    return {'shard': shard, 'num_shards': num_shards}
+
+def _parametro_cache_cron():
+    """Lee `?cache=0|1` de la petición; sin parámetro se usa el valor por defecto (IA_CACHE_CRON)."""
+    valor = request.args.get('cache')
+    if valor is None:
+        return None
+    return valor.lower() not in ('0', 'false', 'no')
+
 @app.route('/cron/generar-misiones')
 def cron_generar_misiones():
     if request.args.get('secret') != app.config['CRON_SECRET_KEY']:
         app.logger.warning("Intento de acceso no autorizado a /cron/generar-misiones")
         return abort(403)
+    if _usar_cola_cron():
+        return _encolar_cron('generar_misiones', db.select(User).where(User.metas_personales != None))
     
-    resultado = _generar_misiones_diarias_logic()
+    resultado = _generar_misiones_diarias_logic(
+        concurrencia=request.args.get('concurrencia', type=int),
+        lote=request.args.get('lote', type=int),
+        usar_cache=_parametro_cache_cron(),
+        **_kwargs_shard()
+    )
     return jsonify(status="ok", message=resultado)
 
 # --- NUEVA RUTA DE CRON ---
@@ -1051,8 +3448,15 @@ def cron_actualizar_tienda():
     if request.args.get('secret') != app.config['CRON_SECRET_KEY']:
         app.logger.warning("Intento de acceso no autorizado a /cron/actualizar-tienda")
         return abort(403)
+    if _usar_cola_cron():
+        return _encolar_cron('actualizar_tienda', db.select(User).where(User.metas_personales != None))
     
-    resultado = _actualizar_tienda_diaria_logic()
+    resultado = _actualizar_tienda_diaria_logic(
+        concurrencia=request.args.get('concurrencia', type=int),
+        lote=request.args.get('lote', type=int),
+        usar_cache=_parametro_cache_cron(),
+        **_kwargs_shard()
+    )
     return jsonify(status="ok", message=resultado)
 
 
@@ -1061,8 +3465,10 @@ def cron_verificar_misiones():
     if request.args.get('secret') != app.config['CRON_SECRET_KEY']:
         app.logger.warning("Intento de acceso no autorizado a /cron/verificar-misiones")
         return abort(403)
+    if _usar_cola_cron():
+        return _encolar_cron('verificar_misiones', None)
         
-    resultado = _verificar_misiones_fallidas_logic()
+    resultado = _verificar_misiones_fallidas_logic(usar_cache=_parametro_cache_cron(), **_kwargs_shard())
     return jsonify(status="ok", message=resultado)
 
 @app.route('/cron/generar-reporte')
@@ -1070,12 +3476,171 @@ def cron_generar_reporte():
     if request.args.get('secret') != app.config['CRON_SECRET_KEY']:
         app.logger.warning("Intento de acceso no autorizado a /cron/generar-reporte")
         return abort(403)
+    if _usar_cola_cron():
+        return _encolar_cron('generar_reporte', db.select(User))
         
-    resultado = _generar_reporte_diario_logic()
+    resultado = _generar_reporte_diario_logic(usar_cache=_parametro_cache_cron(), **_kwargs_shard())
     return jsonify(status="ok", message=resultado)
 
+@app.route('/cron/compactar-economia')
+def cron_compactar_economia():
+    """Vuelca el libro de movimientos sobre las fotos de los usuarios (acepta ?shard=&num_shards=)."""
+    if request.args.get('secret') != app.config['CRON_SECRET_KEY']:
+        app.logger.warning("Intento de acceso no autorizado a /cron/compactar-economia")
+        return abort(403)
+
+    compactados = _compactar_economia(**_kwargs_shard())
+    return jsonify(status="ok", compactados=compactados, tareas_purgadas=_purgar_tareas_terminadas())
 
-# === Comandos CLI para la App (SÓLO init-db) ===
+@app.route('/metrics')
+def metrics():
+    """
+    Métricas del proceso en formato de texto de Prometheus. Se autentica con
+    `Authorization: Bearer <METRICAS_SECRET_KEY>` (o `?secret=`).
+    """
+    secreto = request.args.get('secret', '')
+    autorizacion = request.headers.get('Authorization', '')
+    if autorizacion.startswith('Bearer '):
+        secreto = autorizacion[len('Bearer '):]
+    if not app.config['METRICAS_ACTIVAS'] or not hmac.compare_digest(secreto.encode(), app.config['METRICAS_SECRET_KEY'].encode()):
+        app.logger.warning("Intento de acceso no autorizado a /metrics")
+        return abort(403)
+    return Response(metricas.texto_prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/cron/cache-ia')
+def cron_cache_ia():
+    """Contadores de la caché de la IA. Con `?purgar=1` borra además las entradas expiradas de la BD."""
+    if request.args.get('secret') != app.config['CRON_SECRET_KEY']:
+        app.logger.warning("Intento de acceso no autorizado a /cron/cache-ia")
+        return abort(403)
+
+    purgadas = _purgar_cache_ia() if request.args.get('purgar') == '1' else 0
+    return jsonify(status="ok", cache=estadisticas_cache_ia(), purgadas=purgadas)
+
+@app.route('/cron/estado-cola')
+def cron_estado_cola():
+    """Cuántas tareas hay en la cola por tipo y estado."""
+    if request.args.get('secret') != app.config['CRON_SECRET_KEY']:
+        app.logger.warning("Intento de acceso no autorizado a /cron/estado-cola")
+        return abort(403)
+
+    filas = db.session.execute(
+        db.select(TareaCron.tipo, TareaCron.estado, db.func.count())
+        .group_by(TareaCron.tipo, TareaCron.estado)
+    ).all()
+    estado = {}
+    for tipo, estado_tarea, cantidad in filas:
+        estado.setdefault(tipo, {})[estado_tarea] = cantidad
+    return jsonify(status="ok", cola=estado)
+
+
+# === Comandos CLI para la App ===
+
+def _crear_indices_faltantes(concurrente=False):
+    """
+    `create_all` tampoco crea los índices nuevos de tablas existentes: se crean si faltan.
+    Con `concurrente=True`, en Postgres se usa CREATE INDEX CONCURRENTLY (sin bloquear escrituras).
+    Devuelve los nombres de los índices creados.
+    """
+    inspector = db.inspect(db.engine)
+    creados = []
+    for tabla in db.metadata.sorted_tables:
+        if not inspector.has_table(tabla.name):
+            continue
+        existentes = {i['name'] for i in inspector.get_indexes(tabla.name)}
+        for indice in sorted(tabla.indexes, key=lambda i: i.name):
+            if indice.name in existentes:
+                continue
+            if concurrente and db.engine.dialect.name == 'postgresql':
+                ddl = str(CreateIndex(indice, if_not_exists=True).compile(dialect=db.engine.dialect))
+                ddl = ddl.replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY', 1)
+                # CONCURRENTLY no puede ir dentro de una transacción
+                with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                    conn.execute(db.text(ddl))
+            else:
+                indice.create(db.engine, checkfirst=True)
+            creados.append(indice.name)
+            app.logger.info(f"Índice creado: {indice.name}")
+    return creados
+
+# Índices que un índice compuesto dejó redundantes: (tabla, nombre). Se borran si existen
+INDICES_OBSOLETOS = [
+    ('logro_compartido', 'ix_logro_compartido_timestamp'), # Prefijo de ix_logro_compartido_timestamp_id
+]
+
+def _borrar_indices_obsoletos(concurrente=False):
+    """
+    Borra los INDICES_OBSOLETOS que sigan en una BD existente: cada INSERT dejaría de mantenerlos.
+    Con `concurrente=True`, en Postgres se usa DROP INDEX CONCURRENTLY. Devuelve los nombres borrados.
+    """
+    inspector = db.inspect(db.engine)
+    borrados = []
+    for tabla, nombre in INDICES_OBSOLETOS:
+        if not inspector.has_table(tabla) or nombre not in {i['name'] for i in inspector.get_indexes(tabla)}:
+            continue
+        if db.engine.dialect.name == 'mysql':
+            ddl = f'DROP INDEX {nombre} ON {tabla}'
+        elif concurrente and db.engine.dialect.name == 'postgresql':
+            ddl = f'DROP INDEX CONCURRENTLY IF EXISTS {nombre}'
+        else:
+            ddl = f'DROP INDEX IF EXISTS {nombre}'
+        # CONCURRENTLY no puede ir dentro de una transacción
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.execute(db.text(ddl))
+        borrados.append(nombre)
+        app.logger.info(f"Índice obsoleto borrado: {nombre}")
+    return borrados
+
+# Consultas calientes cuyo plan revisa `flask ensure-indexes`
+CONSULTAS_PLAN = [
+    ("/misiones", "SELECT * FROM mision WHERE user_id = :uid ORDER BY completada, plazo"),
+    ("cron verificar-misiones", "SELECT id, user_id FROM mision WHERE completada = :falso AND plazo < :ahora"),
+    ("/habitos", "SELECT * FROM habito WHERE user_id = :uid"),
+    ("/areas", "SELECT * FROM area_vida WHERE user_id = :uid"),
+    ("/tienda", "SELECT * FROM tienda_item WHERE user_id = :uid"),
+    ("bandeja del asistente", "SELECT id FROM mensaje_asistente WHERE user_id = :uid AND leido = :falso ORDER BY timestamp"),
+    ("saldo (cola del libro)", "SELECT id, xp, pesos, vida FROM movimiento_economia WHERE user_id = :uid AND id > :marca ORDER BY id"),
+]
+
+def _imprimir_planes():
+    explain = 'EXPLAIN QUERY PLAN ' if db.engine.dialect.name == 'sqlite' else 'EXPLAIN '
+    parametros = {'uid': 1, 'falso': False, 'ahora': datetime.utcnow(), 'marca': 0}
+    with db.engine.connect() as conn:
+        for descripcion, sql in CONSULTAS_PLAN:
+            print(f"-- {descripcion}: {sql}")
+            for fila in conn.execute(db.text(explain + sql), parametros):
+                print("   ", fila[-1])
+
+def _agregar_columnas_faltantes():
+    """
+    `create_all` no modifica tablas que ya existen: añade con ALTER TABLE las columnas
+    nuevas de los modelos (con su valor por defecto si es un escalar).
+    Devuelve las columnas añadidas como 'tabla.columna'.
+    """
+    agregadas = []
+    inspector = db.inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    with db.engine.begin() as conn:
+        for tabla in db.metadata.sorted_tables:
+            if not inspector.has_table(tabla.name):
+                continue
+            existentes = {c['name'] for c in inspector.get_columns(tabla.name)}
+            for columna in tabla.columns:
+                if columna.name in existentes:
+                    continue
+                ddl = (f"ALTER TABLE {preparer.quote(tabla.name)} ADD COLUMN "
+                       f"{preparer.quote(columna.name)} {columna.type.compile(dialect=db.engine.dialect)}")
+                if columna.default is not None and columna.default.is_scalar:
+                    valor = columna.default.arg
+                    if isinstance(valor, bool):
+                        valor = 'TRUE' if valor else 'FALSE'
+                    elif isinstance(valor, str):
+                        valor = "'" + valor.replace("'", "''") + "'"
+                    ddl += f" DEFAULT {valor}"
+                conn.execute(db.text(ddl))
+                agregadas.append(f"{tabla.name}.{columna.name}")
+                app.logger.info(f"Columna añadida: {tabla.name}.{columna.name}")
+    return agregadas
 
 @app.cli.command("init-db")
 def init_db_command():
@@ -1083,7 +3648,17 @@ def init_db_command():
     
     # db.drop_all() # Descomentar en desarrollo local si necesitas un reset total
     db.create_all()
+    agregadas = _agregar_columnas_faltantes()
+    _crear_indices_faltantes()
+    _borrar_indices_obsoletos()
+    if {'area_vida.misiones_activas', 'area_vida.num_habitos'} & set(agregadas):
+        _recalcular_contadores_areas() # Las áreas existentes arrancan en 0
     
+    # Fila de versión del feed (caché compartida entre procesos)
+    if db.session.get(VersionCache, 'feed') is None:
+        db.session.add(VersionCache(nombre='feed', version=0))
+        db.session.commit()
+
     # Poblar las personalidades del asistente si la tabla está vacía
     if AsistentePersonalidad.query.count() == 0:
         personalidades = [
@@ -1096,4 +3671,60 @@ def init_db_command():
         db.session.bulk_save_objects(personalidades)
         db.session.commit()
     
-    print("Base de datos inicializada (tablas creadas y personalidades de IA pobladas).")
\ No newline at end of file
+    print("Base de datos inicializada (tablas creadas y personalidades de IA pobladas).")
+
+@app.cli.command("ensure-indexes")
+def ensure_indexes_command():
+    """Crea en línea los índices que falten en una BD existente y muestra los planes antes y después."""
+    print("== Planes ANTES ==")
+    _imprimir_planes()
+
+    creados = _crear_indices_faltantes(concurrente=True)
+    if creados:
+        # Estadísticas frescas para que el planificador considere los índices nuevos
+        with db.engine.begin() as conn:
+            conn.execute(db.text('ANALYZE'))
+    print(f"Índices creados: {', '.join(creados) if creados else 'ninguno (ya estaban todos)'}")
+    borrados = _borrar_indices_obsoletos(concurrente=True)
+    if borrados:
+        print(f"Índices obsoletos borrados: {', '.join(borrados)}")
+
+    print("== Planes DESPUÉS ==")
+    _imprimir_planes()
+
+@app.cli.command("rebuild-counters")
+def rebuild_counters_command():
+    """Recalcula desde cero los contadores de misiones activas y hábitos de cada área."""
+    print(f"Contadores recalculados en {_recalcular_contadores_areas()} área(s).")
+
+@app.cli.command("compact-ledger")
+def compact_ledger_command():
+    """Vuelca el libro de movimientos de la economía sobre la foto de cada usuario y purga la cola de tareas."""
+    print(f"Economía compactada en {_compactar_economia()} usuario(s).")
+    print(f"{_purgar_tareas_terminadas()} tarea(s) terminada(s) borrada(s) de la cola.")
+
+@app.cli.command("worker")
+@click.option('--lote', default=10, show_default=True, help='Tareas a procesar por vuelta (se reclaman de una en una).')
+@click.option('--espera', default=5.0, show_default=True, help='Segundos de espera cuando la cola está vacía.')
+@click.option('--vaciar', is_flag=True, help='Terminar en cuanto la cola quede vacía.')
+def worker_command(lote, espera, vaciar):
+    """Procesa las tareas de Cron encoladas en la BD. Se escala lanzando más procesos."""
+    app.logger.info(f"Worker iniciado (lote={lote}, espera={espera}s)")
+    proxima_purga = monotonic()
+    while True:
+        try:
+            if monotonic() >= proxima_purga: # Como mucho una vez por hora, por worker
+                _purgar_tareas_terminadas()
+                proxima_purga = monotonic() + 3600
+            procesadas = _procesar_cola(lote)
+        except Exception as e:
+            # Un fallo de BD no debe matar al worker: las tareas reclamadas reaparecen al vencer su visibilidad
+            db.session.rollback()
+            app.logger.error(f"Error en el worker: {e}")
+            procesadas = 0
+        if procesadas:
+            continue
+        if vaciar:
+            break
+        sleep(espera)
+    app.logger.info("Worker terminado: cola vacía.")
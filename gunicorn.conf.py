@@ -0,0 +1,14 @@
+# Configuración de gunicorn (se carga sola al arrancar `gunicorn app:app` desde este directorio).
+# Bind y número de workers salen de PORT y WEB_CONCURRENCY, como en el arranque por defecto.
+import os
+
+# Los mensajes del asistente por SSE (ASISTENTE_SSE=1) mantienen abierta cada conexión hasta
+# ASISTENTE_STREAM_SEGUNDOS: con workers sync cada pestaña ocuparía un worker entero y el timeout
+# de 30 s lo mataría a mitad del stream. Con SSE activo se usan workers gthread, con hilos para
+# los streams (ASISTENTE_STREAMS_MAX por proceso) más los de las peticiones normales.
+if os.environ.get('ASISTENTE_SSE', '0') in ('1', 'true', 'True'):
+    worker_class = 'gthread'
+    threads = (
+        int(os.environ.get('ASISTENTE_STREAMS_MAX', 20))
+        + int(os.environ.get('GUNICORN_HILOS_PETICIONES', 8))
+    )